@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Benchmarks
+
+Offline micro-benchmarks for the handlers and the reminder scheduling.
+No network: the telegram.Bot talks to StubRequest, which answers every
+Bot API method locally. The calendar and the chats are synthetic, the
+bot works in a temporary directory.
+
+    python bench_muellbot.py                        # json to stdout
+    python bench_muellbot.py -o bench.json          # json to a file
+    python bench_muellbot.py --compare old.json     # relative change per metric
+
+Timings are in microseconds per call (handlers, lookups) or milliseconds
+per pass (schedule_reminders), memory in KiB (tracemalloc peak).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from telegram import Update
+from telegram.request import BaseRequest
+
+from muell_calendar import (RECYCLING_BEZIRKE, RESTMUELL_BEZIRKE,
+                            events_from_wide, snapshot_path, write_snapshot)
+
+CHAT_COUNTS = [100, 10_000, 100_000]
+DAYS_SHORT = ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']
+
+
+class StubRequest(BaseRequest):
+    """answers every Bot API call without network, like Telegram would"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "muellbot", "username": "muellbot"}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {"message_id": 1, "date": int(time.time()), "text": params.get('text', ''),
+                      "chat": {"id": params.get('chat_id', 1), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def synthetic_calendar(year: int) -> pd.DataFrame:
+    """wide calendar like parse_calendar returns, every district gets pickups"""
+    rows = []
+    d = date(year, 1, 1)
+    while d.year == year:
+        i = d.timetuple().tm_yday
+        workday = d.weekday() < 5
+        rm = f"Bez. {(i % 8) + 1}" if workday and i % 2 == 0 else ""
+        pap = ["Bez. A", "B ", "C ", "D/E ohne Bez.", ""][i % 5] if workday else ""
+        gs = ["", "A ", "Bez. B", "C ", "Bez. E"][i % 5] if workday else ""
+        rows.append((pd.Timestamp(d), DAYS_SHORT[d.weekday()], rm, pap, gs))
+        d += timedelta(days=1)
+    df = pd.DataFrame(rows, columns=["Datum", "Wochentag", "Restmüll", "Papiermüll", "Gelber Sack"])
+    return df.set_index("Datum")
+
+def filter_df(df, pat=r'', row=True, dropna=True):
+    """the old lookup of muellbot (before the calendar index): returns
+    whole rows with pat if row, and drop the rest if dropna"""
+    
+    if row:
+        f = lambda row : row.str.contains(pat).any()
+    else:
+        f = lambda row : row.str.contains(pat)
+    filterframe = df.apply(f, axis=1)
+    if dropna and row:
+        return df.loc[filterframe]
+    elif dropna and not row: # drop as much na as possible
+        return df.where(filterframe).dropna(axis=0, how='all').dropna(axis=1, how='all')
+    else:
+        return df.where(filterframe)
+
+def synthetic_chats(n: int, seed: int = 1) -> dict:
+    """chat_data of n chats, all with reminders on, spread over districts and times"""
+    rnd = random.Random(seed)
+    times = [f"{h:02d}:{m:02d}" for h in range(16, 24) for m in (0, 30)]
+    return {chat_id: {'RM_bezirk': rnd.choice(RESTMUELL_BEZIRKE),
+                      'REC_bezirk': rnd.choice(RECYCLING_BEZIRKE),
+                      'reminders_flag': True,
+                      'reminder_time': rnd.choice(times)}
+            for chat_id in range(1, n + 1)}
+
+def callback_update(bot, chat_id: int, data: str) -> Update:
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {
+            "id": "1", "chat_instance": "1", "data": data,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "message": {"message_id": 1, "date": 0, "text": "menu",
+                        "chat": {"id": chat_id, "type": "private"}}}}, bot)
+
+def stats(samples: list) -> dict:
+    """microseconds per call"""
+    samples = sorted(s * 1e6 for s in samples)
+    return {'n': len(samples),
+            'mean_us': round(statistics.fmean(samples), 2),
+            'p50_us': round(samples[len(samples) // 2], 2),
+            'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2)}
+
+def peak_kib(func, *args) -> float:
+    tracemalloc.start()
+    try:
+        func(*args)
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+async def bench_handlers(mb, rounds: int) -> dict:
+    from telegram.ext import Application, CallbackContext
+
+    request = StubRequest()
+    application = Application.builder().token("123:bench").request(request).build()
+    await application.initialize()
+    chats = synthetic_chats(40)
+    results = {}
+    for name, handler, data in [('heute', mb.heute, 'today'),
+                                ('morgen', mb.morgen, 'tomorrow'),
+                                ('next_date', mb.next_date, 'next')]:
+        updates = [callback_update(application.bot, chat_id, data) for chat_id in chats]
+        for chat_id, cd in chats.items():
+            application.chat_data[chat_id].update(cd)
+
+        mb.render_message.cache_clear()
+        t0 = time.perf_counter()
+        await handler(updates[0], CallbackContext.from_update(updates[0], application))
+        cold = time.perf_counter() - t0
+
+        samples = []
+        for i in range(rounds):
+            update = updates[i % len(updates)]
+            context = CallbackContext.from_update(update, application)
+            t0 = time.perf_counter()
+            await handler(update, context)
+            samples.append(time.perf_counter() - t0)
+        results[name] = dict(stats(samples), cold_us=round(cold * 1e6, 2))
+    await application.shutdown()
+    return results
+
+def bench_lookups(mb, df, rounds: int) -> dict:
+    calendar = mb.CALENDAR.get()
+    pairs = [(rm, rec) for rm in RESTMUELL_BEZIRKE for rec in RECYCLING_BEZIRKE]
+    days = [datetime.combine(d.date(), datetime.min.time()) for d in df.index]
+
+    samples = []
+    for i in range(rounds):
+        rm, rec = pairs[i % len(pairs)]
+        lookday = days[(i * 7) % len(days)]
+        t0 = time.perf_counter()
+        mb.get_next_day(calendar, rm, rec, lookday)
+        samples.append(time.perf_counter() - t0)
+    results = {'get_next_day': dict(stats(samples), per_s=round(len(samples) / sum(samples)))}
+
+    # the old pandas path, kept for comparison
+    samples = []
+    for i in range(max(1, rounds // 100)):
+        rm, rec = pairs[i % len(pairs)]
+        t0 = time.perf_counter()
+        filter_df(df, pat=fr"Bez. {rm}|Bez. {rec}|{rec} ")
+        samples.append(time.perf_counter() - t0)
+    results['filter_df'] = dict(stats(samples), per_s=round(len(samples) / sum(samples), 1))
+    return results
+
+def bench_schedule(mb, counts: list) -> dict:
+    from muell_jobs import TimingWheel
+
+    results = {}
+    for n in counts:
+        chat_data = synthetic_chats(n)
+
+        def one_pass():
+            mb.WHEEL = TimingWheel(mb.TIMEZONE)
+            mb.schedule_reminders(chat_data)
+
+        samples = []
+        for _ in range(5 if n <= 10_000 else 2):
+            t0 = time.perf_counter()
+            one_pass()
+            samples.append(time.perf_counter() - t0)
+        results[str(n)] = {'best_ms': round(min(samples) * 1e3, 2),
+                           'mean_ms': round(statistics.fmean(samples) * 1e3, 2),
+                           'peak_kib': peak_kib(one_pass)}
+    return results
+
+def revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(rounds: int, counts: list) -> dict:
+    workdir = tempfile.mkdtemp(prefix="muellbench")
+    year = datetime.today().year
+    df = synthetic_calendar(year)
+    csv = os.path.join(workdir, f"AK_{year}_komplett.csv")
+    df.to_csv(csv)
+    write_snapshot(snapshot_path(csv), *events_from_wide(df))
+
+    # the bot finds its calendar in the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return _run(year, df, rounds, counts)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _run(year, df, rounds, counts) -> dict:
+    import logging
+    import muellbot as mb
+    logging.getLogger().setLevel(logging.WARNING)
+    mb.DEBUG = False
+
+    t0 = time.perf_counter()
+    mb.CALENDAR.year(year)
+    load_ms = (time.perf_counter() - t0) * 1e3
+
+    results = {
+        'meta': {'revision': revision(),
+                 'python': platform.python_version(),
+                 'time': datetime.now().isoformat(timespec='seconds'),
+                 'rounds': rounds},
+        'calendar_load_ms': round(load_ms, 2),
+        'handlers': asyncio.run(bench_handlers(mb, rounds)),
+        'lookups': bench_lookups(mb, df, rounds),
+        'schedule_reminders': bench_schedule(mb, counts),
+    }
+    results['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    """{'handlers.heute.p50_us': 12.3, ...} for the numeric metrics"""
+    flat = {}
+    for k, v in results.items():
+        if k == 'meta':
+            continue
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)):
+            flat[prefix + k] = v
+    return flat
+
+def compare(old: dict, new: dict) -> str:
+    old, new = flatten(old), flatten(new)
+    lines = []
+    for k in sorted(set(old) & set(new)):
+        change = (new[k] - old[k]) / old[k] * 100 if old[k] else 0
+        lines.append(f"{k:50s} {old[k]:>14} {new[k]:>14} {change:+8.1f}%")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks for muellbot")
+    parser.add_argument("-o", "--output", help="write the json results to this file")
+    parser.add_argument("-n", "--rounds", type=int, default=2000, help="calls per handler / lookup")
+    parser.add_argument("--chats", type=int, nargs="+", default=CHAT_COUNTS,
+                        help="chat populations for schedule_reminders")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare with")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    results = run(args.rounds, args.chats)
+    dumped = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(dumped + "\n")
+    else:
+        print(dumped)
+    if args.compare:
+        print(compare(old, results), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
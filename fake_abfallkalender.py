@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Fake Abfuhrkalender
+
+Local stand-in for the Abfuhrkalender page of the Landratsamt, to try
+scrape_Abfallkalender.py without asking the real server. Serves the
+files of a fixture directory, / is its index.html:
+
+    fixtures/index.html                 <a href="pdf/Abfuhrkalender_2026.pdf">...
+    fixtures/pdf/Abfuhrkalender_2026.pdf
+
+ETag (content hash) and Last-Modified (mtime) are sent and If-None-Match /
+If-Modified-Since are answered with 304, like a well behaved web server.
+Replace a file in the directory to simulate a new calendar.
+
+    python fake_abfallkalender.py fixtures --port 8082
+    python scrape_Abfallkalender.py --once --url http://127.0.0.1:8082/
+"""
+
+import argparse
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote
+
+from muell_http import QuietHandler, start_server
+from muell_ical import etag_matches
+
+logger = logging.getLogger(__name__)
+
+
+class FakeAbfallkalender:
+    """serves directory, counts the answers by status"""
+
+    def __init__(self, directory: str, validators: bool = True):
+        """validators: False sends neither ETag nor Last-Modified (every GET is a 200)"""
+        self.directory = os.path.abspath(directory)
+        self.validators = validators
+        self.server = None
+        self._lock = threading.Lock()
+        self.stats = {'200': 0, '304': 0, '404': 0}
+        self.requests = []          # (path, status)
+
+    def start(self, host: str = "127.0.0.1", port: int = 0):
+        class Handler(FixtureHandler):
+            pass
+        Handler.fake = self
+        self.server = start_server(Handler, host, port, name="fake_abfallkalender")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def resolve(self, path: str):
+        """file for the request path, None if there is none (or it is outside directory)"""
+        path = posixpath.normpath(unquote(path.split('?', 1)[0]))
+        if path in ('/', '.'):
+            path = '/index.html'
+        fn = os.path.join(self.directory, path.lstrip('/'))
+        if not fn.startswith(self.directory + os.sep) or not os.path.isfile(fn):
+            return None
+        return fn
+
+    def record(self, path: str, status: int):
+        with self._lock:
+            self.stats[str(status)] += 1
+            self.requests.append((path, status))
+
+
+class FixtureHandler(QuietHandler):
+    """GET/HEAD of the fixture files with conditional requests"""
+
+    fake: FakeAbfallkalender = None
+
+    def do_GET(self):
+        fn = self.fake.resolve(self.path)
+        if fn is None:
+            self.fake.record(self.path, 404)
+            self.send_body(404, b"not found\n", "text/plain")
+            return
+
+        with open(fn, 'rb') as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(fn)[0] or "application/octet-stream"
+        headers = {}
+        if self.fake.validators:
+            mtime = int(os.stat(fn).st_mtime)
+            headers = {'ETag': '"' + hashlib.sha256(body).hexdigest()[:32] + '"',
+                       'Last-Modified': formatdate(mtime, usegmt=True)}
+            if self.not_modified(headers['ETag'], mtime):
+                self.fake.record(self.path, 304)
+                self.send_response(304)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.fake.record(self.path, 200)
+        self.send_body(200, body, content_type, headers)
+
+    do_HEAD = do_GET
+
+    def not_modified(self, etag: str, mtime: int) -> bool:
+        """If-None-Match wins over If-Modified-Since (RFC 9110)"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local fake Abfuhrkalender page")
+    parser.add_argument("directory", help="fixture directory with index.html and the PDFs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--no-validators", action="store_true", help="send neither ETag nor Last-Modified")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    fake = FakeAbfallkalender(args.directory, validators=not args.no_validators).start(args.host, args.port)
+    logger.info("url %s", fake.url)
+    try:
+        while True:
+            time.sleep(60)
+            logger.info("%s", fake.stats)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
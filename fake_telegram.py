@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Fake Telegram
+
+Local stand-in for the Telegram Bot API, enough for muellbot:
+getMe, getUpdates, sendMessage, editMessageText, answerCallbackQuery,
+setMyCommands, setWebhook and deleteWebhook. Point the bot at it with
+    base_url    http://127.0.0.1:8081/bot
+in the config.
+
+Updates are queued with push_update() and handed out by getUpdates
+(long polling). Once the bot called setWebhook, they are POSTed to its
+url instead, with the X-Telegram-Bot-Api-Secret-Token it asked for and
+at most max_connections at once, like Telegram does. Every call of the
+bot is recorded and passed to the listeners, so a load generator can
+match answers to its updates.
+Latency and flood limits (429 with retry_after) are configurable.
+
+    python fake_telegram.py --port 8081 --latency 0.05 --flood-rate 0.01
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+from muell_http import QuietHandler, start_server
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Muellbot", "username": "muellbot"}
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_RETRIES = 10 # per update, on connection errors
+# methods that produce a message the user can see
+MESSAGE_METHODS = ('sendMessage', 'editMessageText')
+
+
+class FakeTelegram:
+    """state of the fake Bot API, shared by all request threads"""
+
+    def __init__(self, latency: float = 0, jitter: float = 0, flood_rate: float = 0,
+                 global_limit: int = None, retry_after: int = 1):
+        """latency/jitter: seconds added to every call (uniform jitter)
+        flood_rate: share of sendMessage/editMessageText answered with 429
+        global_limit: sendMessage per second (over all chats), more are answered
+        with 429 as well. Edits of the bot's own menu message are not counted."""
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.server = None
+        self._stopped = False
+
+        self._updates = deque()     # pending updates for getUpdates
+        self._next_update_id = 1
+        self._cond = threading.Condition()
+        self._sent = deque()        # send times of the last second, for global_limit
+        self._message_ids = {}      # chat_id -> last message_id
+        self.listeners = []         # callback(method, chat_id, params, t)
+        self.stats = {'updates': 0, 'calls': 0, 'flood': 0, 'webhook_errors': 0}
+        self.calls = {}             # method -> count
+        self.polling = threading.Event() # set on the first getUpdates
+        self.webhook = None         # {'url': ..., 'secret_token': ...} after setWebhook
+        self.webhook_set = threading.Event()
+        self._delivery = None       # ThreadPoolExecutor POSTing to the webhook
+
+    # --- control side ---
+    def start(self, host: str = "127.0.0.1", port: int = 0):
+        fake = self
+
+        class Handler(BotAPIHandler):
+            telegram = fake
+        self.server = start_server(Handler, host, port, name="fake_telegram")
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._delivery:
+            self._delivery.shutdown(wait=False, cancel_futures=True)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def push_update(self, update: dict) -> int:
+        """queues an update (without update_id), or sends it to the webhook
+        if one is set, returns its update_id"""
+        with self._cond:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            self.stats['updates'] += 1
+            if self.webhook is None:
+                self._updates.append(update)
+                self._cond.notify_all()
+                return update['update_id']
+            delivery = self._delivery
+        delivery.submit(self._deliver_logged, update)
+        return update['update_id']
+
+    def deliver(self, update: dict, headers: dict = None) -> int:
+        """POSTs update to the webhook, headers default to the secret token
+        of setWebhook. Returns the http status of the bot."""
+        webhook = self.webhook
+        if headers is None:
+            headers = {SECRET_HEADER: webhook['secret_token']} if webhook['secret_token'] else {}
+        request = urllib.request.Request(webhook['url'], data=json.dumps(update).encode(), method='POST',
+                                         headers=dict(headers, **{'Content-Type': 'application/json'}))
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def _deliver_logged(self, update: dict):
+        # the bot calls setWebhook before its server is up, Telegram retries as well
+        for attempt in range(WEBHOOK_RETRIES):
+            try:
+                status = self.deliver(update)
+                break
+            except OSError as e:
+                status = e
+                time.sleep(0.5)
+        if status != 200:
+            with self._cond:
+                self.stats['webhook_errors'] += 1
+            logger.warning("Update %d not delivered to the webhook: %s", update['update_id'], status)
+
+    def set_webhook(self, url: str = None, secret_token: str = None, max_connections: int = 40):
+        """setWebhook / deleteWebhook (url None)"""
+        with self._cond:
+            old = self._delivery
+            if url:
+                self.webhook = {'url': url, 'secret_token': secret_token}
+                self._delivery = ThreadPoolExecutor(max_connections, thread_name_prefix="webhook")
+                self.webhook_set.set()
+            else:
+                self.webhook = None
+                self._delivery = None
+                self.webhook_set.clear()
+        if old:
+            old.shutdown(wait=False)
+
+    # --- Bot API side ---
+    def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        self.polling.set()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # everything before offset is confirmed
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopped:
+                    return []
+                self._cond.wait(remaining)
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.popleft()
+            return list(self._updates)[:limit]
+
+    def flooded(self, method: str, now: float) -> bool:
+        if self.flood_rate and random.random() < self.flood_rate:
+            return True
+        if self.global_limit and method == 'sendMessage':
+            with self._cond:
+                while self._sent and now - self._sent[0] > 1:
+                    self._sent.popleft()
+                if len(self._sent) >= self.global_limit:
+                    return True
+                self._sent.append(now)
+        return False
+
+    def message(self, chat_id, text: str, message_id: int = None) -> dict:
+        with self._cond:
+            if message_id is None:
+                message_id = self._message_ids.get(chat_id, 0) + 1
+                self._message_ids[chat_id] = message_id
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "from": BOT_USER, "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"}}
+
+    def call(self, method: str, params: dict):
+        """-> (http status, response dict)"""
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        now = time.monotonic()
+        with self._cond:
+            self.stats['calls'] += 1
+            self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+
+        if method in MESSAGE_METHODS and self.flooded(method, now):
+            with self._cond:
+                self.stats['flood'] += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            result = self.get_updates(int(params.get('offset') or 0), int(params.get('limit') or 100),
+                                      float(params.get('timeout') or 0))
+        elif method == 'sendMessage':
+            result = self.message(chat_id, params.get('text', ''))
+        elif method == 'editMessageText':
+            result = self.message(chat_id, params.get('text', ''), int(params.get('message_id') or 1))
+        elif method == 'setWebhook':
+            self.set_webhook(params.get('url'), params.get('secret_token'),
+                             int(params.get('max_connections') or 40))
+            result = True
+        elif method == 'deleteWebhook':
+            self.set_webhook(None)
+            result = True
+        elif method in ('answerCallbackQuery', 'setMyCommands'):
+            result = True
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+        t = time.monotonic()
+        for listener in self.listeners:
+            listener(method, chat_id, params, t)
+        return 200, {"ok": True, "result": result}
+
+
+class BotAPIHandler(QuietHandler):
+    """/bot<token>/<method>, parameters as form, json or query string"""
+
+    telegram: FakeTelegram = None
+
+    def do_GET(self):
+        self.handle_call(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or '{}')
+        else:
+            params = parse_qs(body)
+        self.handle_call(params)
+
+    def handle_call(self, params: dict):
+        # parse_qs gives lists
+        params = {k: v[0] if isinstance(v, list) else v for k, v in params.items()}
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        status, response = self.telegram.call(method, params)
+        self.send_json(status, response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local fake Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many seconds more")
+    parser.add_argument("--flood-rate", type=float, default=0, help="share of messages answered with 429")
+    parser.add_argument("--global-limit", type=int, default=None, help="sendMessage per second before 429")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    fake = FakeTelegram(args.latency, args.jitter, args.flood_rate, args.global_limit).start(args.host, args.port)
+    logger.info("base_url %s", fake.base_url)
+    try:
+        while True:
+            time.sleep(60)
+            logger.info("%s %s", fake.stats, fake.calls)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Lasttest
+
+End-to-end load test: muellbot.py runs unchanged (main(), polling or
+webhook, persistence, Outbox) in its own process against fake_telegram.py.
+
+    - sessions: synthetic chats go through /start, the district settings,
+      the menu and the reminder toggle, each step waits for the bot's answer
+    - burst: subscribers are put into the database with a reminder time
+      shortly after startup, like the 20:00 burst, and all of them have a
+      pickup tomorrow
+    - webhook (--webhook): the fake POSTs the updates to the bot's
+      webhook with the secret token, requests without or with a wrong
+      token have to be rejected with 403
+    - restart (--kill-worker, with --workers): one worker is killed with
+      SIGKILL after the burst, once the supervisor restarted it one chat
+      of every shard sends /help and has to get an answer
+
+Reports p50/p99 of the answer latency (update queued -> message sent or
+edited) and how long the reminder burst took to drain, as JSON.
+
+    python loadtest_muellbot.py --chats 2000 --burst 1000 --latency 0.02 --flood-rate 0.01
+    python loadtest_muellbot.py --chats 2000 --burst 1000 --workers 4
+    python loadtest_muellbot.py --chats 2000 --burst 1000 --webhook
+    python loadtest_muellbot.py --chats 500 --burst 500 --workers 3 --kill-worker
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from pytz import timezone
+
+from bench_muellbot import synthetic_calendar
+from fake_telegram import BOT_USER, MESSAGE_METHODS, SECRET_HEADER, FakeTelegram
+from muell_calendar import (RECYCLING_BEZIRKE, RESTMUELL_BEZIRKE,
+                            events_from_wide, snapshot_path, write_snapshot)
+from muell_persistence import SCHEMA
+
+TIMEZONE = timezone('Europe/Berlin') # as in muellbot
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:loadtest"
+DEV_ID = 42
+MIN_THINK = 0.05 # seconds between the answer and the next step of a session
+PROBE_CHATS = 20_000_000 # chats of the --kill-worker check
+
+# one session of a new chat: (kind, payload)
+SESSION = [
+    ('command', '/start'),
+    ('callback', 'trash'), ('callback', 'RM'),
+    ('callback', 'recycling'), ('callback', 'REC'),
+    ('callback', 'done'),
+    ('callback', 'today'), ('callback', 'tomorrow'), ('callback', 'next'),
+    ('callback', 'week'),
+    ('callback', 'reminders'), ('callback', 'reminders'),
+    ('callback', 'close'),
+]
+
+
+def prepare(workdir: str, burst: int, reminder_time: str, base_url: str, workers: int = 1,
+            webhook_port: int = None, webhook_secret: str = None):
+    """config, calendar and database for the bot in workdir"""
+
+    with open(os.path.join(workdir, "devbot.conf"), "w") as f:
+        f.write(f"token {TOKEN}\ndev_id {DEV_ID}\nbase_url {base_url}\nworkers {workers}\n")
+        if webhook_port:
+            f.write(f"webhook_url http://127.0.0.1:{webhook_port}/telegram\nwebhook_port {webhook_port}\n"
+                    f"webhook_secret {webhook_secret}\n")
+
+    # every district has a pickup tomorrow, so every subscriber gets a reminder
+    tomorrow = (datetime.now(TIMEZONE) + timedelta(days=1)).date()
+    for year in {datetime.now(TIMEZONE).year, tomorrow.year}:
+        df = synthetic_calendar(year)
+        if tomorrow.year == year:
+            df.loc[str(tomorrow), 'Restmüll'] = "Bez. " + "/".join(RESTMUELL_BEZIRKE)
+            df.loc[str(tomorrow), 'Papiermüll'] = "Bez. " + "/".join(RECYCLING_BEZIRKE)
+        csv = os.path.join(workdir, f"AK_{year}_komplett.csv")
+        df.to_csv(csv)
+        write_snapshot(snapshot_path(csv), *events_from_wide(df))
+
+    db = sqlite3.connect(os.path.join(workdir, "muellbot.sqlite"))
+    db.executescript(SCHEMA)
+    rnd = random.Random(2)
+    db.executemany("INSERT INTO chat_data VALUES (?, ?)", [
+        (chat_id, json.dumps({'RM_bezirk': rnd.choice(RESTMUELL_BEZIRKE),
+                              'REC_bezirk': rnd.choice(RECYCLING_BEZIRKE),
+                              'reminders_flag': True, 'reminder_time': reminder_time}))
+        for chat_id in burst_chats(burst)])
+    db.commit()
+    db.close()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_listening(port: int, timeout: float = 30) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def check_secret(fake: FakeTelegram, secret: str) -> dict:
+    """http status of the webhook for updates without, with a wrong and with the right token"""
+    # a chat none of the sessions uses
+    update = lambda: dict(command_update(DEV_ID, "/help"), update_id=0)
+    return {'no_secret': fake.deliver(update(), headers={}),
+            'wrong_secret': fake.deliver(update(), headers={SECRET_HEADER: secret + "x"}),
+            'secret': fake.deliver(update(), headers={SECRET_HEADER: secret}),
+            'registered_secret_matches': (fake.webhook or {}).get('secret_token') == secret}
+
+def worker_pids(pid: int) -> set:
+    """the worker processes (multiprocessing spawn) of the bot, Linux only"""
+    pids = set()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid and b"spawn_main" in cmdline and b"resource_tracker" not in cmdline:
+            pids.add(int(name))
+    return pids
+
+def kill_worker(test: "LoadTest", bot_pid: int, workers: int, timeout: float = 60) -> dict:
+    """SIGKILLs one worker, waits for its successor and sends /help from one
+    chat of every shard (chat_id % workers covers all shards)"""
+    before = worker_pids(bot_pid)
+    if not before:
+        return {'error': "no worker processes found"}
+    victim = min(before)
+    os.kill(victim, signal.SIGKILL)
+    t0 = time.monotonic()
+    successor = set()
+    while not successor and time.monotonic() - t0 < timeout:
+        time.sleep(0.2)
+        successor = worker_pids(bot_pid) - before
+    restarted = time.monotonic() - t0
+    if not successor:
+        return {'killed': victim, 'restarted': False}
+
+    chat_ids = [PROBE_CHATS + i for i in range(workers)]
+    answered = asyncio.run(test.probe(chat_ids))
+    return {'killed': victim, 'restarted': True, 'restarted_after_s': round(restarted, 2),
+            'answered': answered, 'shards': workers}
+
+def burst_chats(n: int) -> range:
+    return range(10_000_000, 10_000_000 + n)
+
+def user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+def command_update(chat_id: int, text: str) -> dict:
+    return {"message": {"message_id": 1, "date": int(time.time()), "text": text,
+                        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+                        "from": user(chat_id), "chat": {"id": chat_id, "type": "private"}}}
+
+def callback_update(chat_id: int, data: str, message_id: int) -> dict:
+    return {"callback_query": {"id": f"{chat_id}-{time.monotonic_ns()}", "chat_instance": str(chat_id),
+                               "data": data, "from": user(chat_id),
+                               "message": {"message_id": message_id, "date": int(time.time()), "text": "menu",
+                                           "from": BOT_USER, "chat": {"id": chat_id, "type": "private"}}}}
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'n': 0}
+    samples = sorted(samples)
+    at = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1e3, 2)
+    return {'n': len(samples), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': round(samples[-1] * 1e3, 2)}
+
+
+class LoadTest:
+
+    def __init__(self, fake: FakeTelegram, timeout: float, think: float):
+        self.fake = fake
+        self.timeout = timeout
+        self.think = think
+        self.loop = None
+        self.waiting = {}       # chat_id -> Future of the next answer
+        self.latencies = []
+        self.timeouts = 0
+        self.burst = set()
+        self.burst_times = []   # monotonic send times of the reminders
+        fake.listeners.append(self.on_call)
+
+    def on_call(self, method, chat_id, params, t):
+        """runs in the threads of the fake server"""
+        if method not in MESSAGE_METHODS:
+            return
+        if chat_id in self.burst and 'Erinnerung' in params.get('text', ''):
+            self.burst_times.append(t)
+            return
+        future = self.waiting.get(chat_id)
+        if future is not None:
+            self.loop.call_soon_threadsafe(lambda: future.done() or future.set_result(t))
+
+    async def step(self, chat_id: int, update: dict):
+        future = self.loop.create_future()
+        self.waiting[chat_id] = future
+        t0 = time.monotonic()
+        self.fake.push_update(update)
+        try:
+            t = await asyncio.wait_for(future, self.timeout)
+            self.latencies.append(t - t0)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        finally:
+            self.waiting.pop(chat_id, None)
+
+    async def session(self, chat_id: int, slots: asyncio.Semaphore, delay: float):
+        rm, rec = random.choice(RESTMUELL_BEZIRKE), random.choice(RECYCLING_BEZIRKE)
+        await asyncio.sleep(delay)
+        async with slots:
+            for message_id, (kind, payload) in enumerate(SESSION, 1):
+                if kind == 'command':
+                    update = command_update(chat_id, payload)
+                else:
+                    payload = {'RM': rm, 'REC': rec}.get(payload, payload)
+                    update = callback_update(chat_id, payload, message_id)
+                await self.step(chat_id, update)
+                # the answer is sent before the handler returns its next conversation state,
+                # nobody taps the next button within a millisecond
+                await asyncio.sleep(MIN_THINK + random.uniform(0, self.think))
+
+    async def run(self, chats: int, concurrency: int, rate: float):
+        """chats arrive at rate per second, at most concurrency sessions at once"""
+        self.loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+        t0 = time.monotonic()
+        await asyncio.gather(*(self.session(chat_id, slots, (chat_id - 1) / rate)
+                               for chat_id in range(1, chats + 1)))
+        return time.monotonic() - t0
+
+    async def probe(self, chat_ids) -> int:
+        """sends /help from every chat, returns how many got an answer"""
+        self.loop = asyncio.get_running_loop()
+        answered = len(self.latencies)
+        await asyncio.gather(*(self.step(chat_id, command_update(chat_id, "/help")) for chat_id in chat_ids))
+        return len(self.latencies) - answered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test of muellbot against a fake Bot API")
+    parser.add_argument("--chats", type=int, default=1000, help="chats going through a menu session")
+    parser.add_argument("--concurrency", type=int, default=200, help="sessions at the same time")
+    parser.add_argument("--rate", type=float, default=20, help="new sessions per second")
+    parser.add_argument("--think", type=float, default=0.2, help="up to this many seconds more between two steps")
+    parser.add_argument("--burst", type=int, default=1000, help="subscribers in the reminder burst")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the bot (muell_shards)")
+    parser.add_argument("--webhook", action="store_true", help="updates are POSTed to the bot's webhook")
+    parser.add_argument("--kill-worker", action="store_true",
+                        help="kill a worker after the burst and check that its shard answers again")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake Bot API latency per call (s)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of messages answered with 429")
+    parser.add_argument("--global-limit", type=int, default=30, help="sendMessage per second before 429")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for one answer")
+    parser.add_argument("-o", "--output", help="write the json results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory (bot log, database)")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency, args.jitter, args.flood_rate, args.global_limit).start()
+    test = LoadTest(fake, args.timeout, args.think)
+    test.burst = set(burst_chats(args.burst))
+
+    # the burst starts at the first full minute at least a minute from now
+    burst_at = (datetime.now(TIMEZONE) + timedelta(seconds=90)).replace(second=0, microsecond=0)
+    workdir = tempfile.mkdtemp(prefix="muellload")
+    webhook_port = free_port() if args.webhook else None
+    webhook_secret = secrets.token_urlsafe(16)
+    prepare(workdir, args.burst, burst_at.strftime("%H:%M"), fake.base_url, args.workers,
+            webhook_port, webhook_secret)
+
+    log = open(os.path.join(workdir, "muellbot.log"), "w")
+    bot = subprocess.Popen([sys.executable, os.path.join(HERE, "muellbot.py")],
+                           cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    results = {'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'args': vars(args)}}
+    try:
+        ready = fake.webhook_set if args.webhook else fake.polling
+        if not ready.wait(60) or (args.webhook and not wait_listening(webhook_port)):
+            raise RuntimeError(f"bot did not start {'the webhook' if args.webhook else 'polling'}, "
+                               f"see {workdir}/muellbot.log")
+        if args.webhook:
+            results['webhook'] = check_secret(fake, webhook_secret)
+
+        duration = asyncio.run(test.run(args.chats, args.concurrency, args.rate))
+        results['sessions'] = {'chats': args.chats, 'steps': len(test.latencies) + test.timeouts,
+                               'timeouts': test.timeouts, 'seconds': round(duration, 2),
+                               'latency': percentiles(test.latencies)}
+
+        # wait for the burst: it starts at burst_at and sends about 25 messages/s
+        burst_start = time.monotonic() + (burst_at - datetime.now(TIMEZONE)).total_seconds()
+        deadline = burst_start + 60 + args.burst / 10
+        while len(test.burst_times) < args.burst and time.monotonic() < deadline and bot.poll() is None:
+            time.sleep(0.5)
+        times = sorted(test.burst_times)
+        results['burst'] = {'chats': args.burst, 'sent': len(times),
+                            'first_after_s': round(times[0] - burst_start, 2) if times else None,
+                            'drain_s': round(times[-1] - times[0], 2) if times else None,
+                            'per_s': round(len(times) / (times[-1] - times[0]), 1) if len(times) > 1 else None}
+        if args.kill_worker and args.workers > 1:
+            results['restart'] = kill_worker(test, bot.pid, args.workers)
+        results['fake_telegram'] = dict(fake.stats, calls=fake.calls)
+    finally:
+        if bot.poll() is None:
+            t0 = time.monotonic()
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            results['shutdown'] = {'seconds': round(time.monotonic() - t0, 2), 'returncode': bot.wait()}
+        log.close()
+        fake.stop()
+        if args.keep:
+            results['meta']['workdir'] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    dumped = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(dumped + "\n")
+    else:
+        print(dumped)
+
+if __name__ == "__main__":
+    main()
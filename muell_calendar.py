@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+"""
+Kalender im Speicher
+
+Loads the Abfuhrkalender once and shares it between all handlers and jobs.
+The file is only parsed again when its mtime or content hash changes.
+Matching of the districts is done once per load, handlers only do lookups.
+CalendarRegistry covers several years, each year is loaded when a query
+first reaches into it.
+
+Besides AK_{YEAR}_komplett.csv, parse_muell_pdf writes a binary snapshot
+AK_{YEAR}_komplett.muellcal:
+
+    header  8s magic, u2 version, u2 reserved, u4 header size, u4 record count,
+            JSON {"categories": [...], "districts": [...]}, padded to 8 bytes
+    records RECORD_DTYPE, one per (day, category, district) pickup
+
+The snapshot is opened with mmap and the records are used without copying,
+so several bot processes on one host share the same page cache.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+RESTMUELL_BEZIRKE = ['1', '2', '3', '4', '5', '6', '7', '8']
+RECYCLING_BEZIRKE = ['A', 'B', 'C', 'D', 'E']
+DISTRICTS = RESTMUELL_BEZIRKE + RECYCLING_BEZIRKE
+
+SNAPSHOT_MAGIC = b'MUELLCAL'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sHHII')
+FILE_MODE = 0o644 # calendar files are readable by everyone, see replaced
+# day = days since 1970-01-01, category/district = index into the header lists
+RECORD_DTYPE = np.dtype([('day', '<i4'), ('category', 'u1'), ('district', 'u1')])
+NO_DAYS = np.array([], dtype='datetime64[D]')
+# Restmüll is collected per number district, everything else per letter district
+CATEGORY_DISTRICTS = {'Restmüll': RESTMUELL_BEZIRKE}
+# 'D/E ohne Bez.'
+SPECIAL_CELL = re.compile(r'^(.+?)\s+ohne Bez\.$')
+DISTRICT_SEPARATOR = re.compile(r'\s*(?:/|,|\+|\bund\b|\s)\s*')
+# AK_2023_komplett.csv or AK_2023_komplett.muellcal
+CALENDAR_FILE = re.compile(r'^AK_(\d{4})_komplett\.(csv|muellcal)$')
+
+
+def read_calendar_csv(fn: str) -> pd.DataFrame:
+    """reads AK_{YEAR}_komplett.csv as written by parse_muell_pdf"""
+    return pd.read_csv(fn,
+                       index_col=0,
+                       keep_default_na=False,
+                       parse_dates=True,
+                       )
+
+def file_digest(fn: str, chunk_size: int = 1 << 16) -> str:
+    """sha256 of the file content"""
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_cell(cell: str, allowed: list = DISTRICTS) -> list:
+    """one calendar cell -> districts, e.g.
+        'Bez. 3' -> ['3'], 'A ' -> ['A'], 'D/E ohne Bez.' -> ['D', 'E'], '' -> []
+    raises ValueError for anything that is not a list of allowed districts"""
+    
+    text = cell.strip()
+    if not text:
+        return []
+    m = SPECIAL_CELL.match(text)
+    if m:
+        # several districts, written without the Bez. prefix
+        text = m.group(1)
+    elif text.startswith('Bez.'):
+        text = text[len('Bez.'):]
+    districts = [d for d in DISTRICT_SEPARATOR.split(text) if d]
+    if not districts or any(d not in allowed for d in districts):
+        raise ValueError(f"{cell!r} is not a district ({', '.join(allowed)})")
+    return districts
+
+def events_table(df: pd.DataFrame) -> pd.DataFrame:
+    """wide calendar (one column per category, free text cells) -> tidy table
+    with one row per (date, category, district) pickup, category and district
+    are categoricals. All invalid cells are reported at once."""
+    
+    categories = [c for c in df.columns if c != 'Wochentag']
+    parts = []
+    errors = []
+    for k in categories:
+        cells = df[k].astype(str)
+        allowed = CATEGORY_DISTRICTS.get(k, RECYCLING_BEZIRKE)
+        # few different cells per column, each one is parsed once
+        parsed = {}
+        for cell in cells.unique():
+            try:
+                parsed[cell] = parse_cell(cell, allowed)
+            except ValueError as e:
+                first = cells.index[(cells == cell).values][0]
+                errors.append(f"{pd.Timestamp(first).date()} {k}: {e}")
+        if errors:
+            continue
+        districts = cells.map(parsed).explode().dropna()
+        parts.append(pd.DataFrame({'date': districts.index.values,
+                                   'category': k,
+                                   'district': districts.values}))
+    if errors:
+        raise ValueError("invalid calendar entries:\n" + "\n".join(errors))
+    
+    events = pd.concat(parts, ignore_index=True)
+    events['date'] = events['date'].astype('datetime64[ns]')
+    events['category'] = pd.Categorical(events['category'], categories=categories)
+    events['district'] = pd.Categorical(events['district'], categories=DISTRICTS)
+    return events.sort_values(['date', 'category', 'district'], ignore_index=True)
+
+def records_from_events(events: pd.DataFrame):
+    """tidy table -> (categories, records), the codes of the categoricals
+    are the indices stored in the records"""
+    
+    records = np.empty(len(events), dtype=RECORD_DTYPE)
+    records['day'] = events['date'].values.astype('datetime64[D]').astype('<i4')
+    records['category'] = events['category'].cat.codes.values
+    records['district'] = events['district'].cat.codes.values
+    return list(events['category'].cat.categories), records
+
+def snapshot_path(fn: str) -> str:
+    """AK_2023_komplett.csv -> AK_2023_komplett.muellcal"""
+    return os.path.splitext(fn)[0] + '.muellcal'
+
+def events_from_wide(df: pd.DataFrame):
+    """wide calendar (one column per category, free text cells) -> (categories, records)
+    with one record per (day, category, district)"""
+    
+    return records_from_events(events_table(df))
+
+@contextmanager
+def replaced(fn: str, mode: str = 'wb', **kwargs):
+    """file object of a temporary file next to fn, renamed to fn when the block
+    ends without error. A running bot reads the old or the new file, never half of one."""
+    
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)), suffix='.tmp')
+    # mkstemp creates it 0600, the bot may run as another user than the parser
+    os.fchmod(fd, FILE_MODE)
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    os.replace(tmp, fn)
+
+def write_snapshot(fn: str, categories: list, records: np.ndarray):
+    """writes the binary snapshot. The file is replaced atomically,
+    processes that still map the old version keep reading the old inode."""
+    
+    meta = json.dumps({'categories': categories, 'districts': DISTRICTS}).encode()
+    header_size = SNAPSHOT_HEADER.size + len(meta)
+    header_size += -header_size % 8
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, header_size, len(records))
+    
+    with replaced(fn) as f:
+        f.write((header + meta).ljust(header_size, b'\0'))
+        f.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+
+def read_snapshot(fn: str):
+    """maps the snapshot -> (categories, districts, records).
+    records is a read only view on the mapping, nothing is copied."""
+    
+    with open(fn, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, header_size, count = SNAPSHOT_HEADER.unpack_from(mm)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"{fn} is not a calendar snapshot (version {SNAPSHOT_VERSION})")
+    meta = json.loads(mm[SNAPSHOT_HEADER.size:header_size].rstrip(b'\0'))
+    # the array keeps the mapping alive
+    records = np.frombuffer(mm, dtype=RECORD_DTYPE, count=count, offset=header_size)
+    return meta['categories'], meta['districts'], records
+
+def ceil_day(lookday) -> np.datetime64:
+    """first whole day at or after lookday (date, datetime or numpy day)"""
+    day = np.datetime64(lookday, 'D')
+    if day < np.datetime64(lookday):
+        day += np.timedelta64(1, 'D')
+    return day
+
+def as_datetime(day: np.datetime64) -> datetime:
+    """numpy day -> datetime at midnight"""
+    return day.astype('datetime64[us]').item()
+
+def year_of(day) -> int:
+    """year of a date, datetime or numpy day"""
+    return int(np.datetime64(day, 'D').astype('datetime64[Y]').astype(int)) + 1970
+
+
+class Calendar:
+    """One loaded version of the calendar.
+    Never changed after construction, so handlers can keep a reference
+    while another thread swaps in a newer version."""
+
+    def __init__(self, categories: list, records: np.ndarray,
+                 districts: list = DISTRICTS, digest: str = None):
+        self.categories = categories
+        self.districts = districts
+        self.records = records
+        self.digest = digest
+        self.loaded_at = datetime.now()
+
+        # (RM_bezirk, REC_bezirk) -> {Kategorie: sorted array of days}
+        self._pickups = {}
+        # (RM_bezirk, REC_bezirk) -> sorted array of all days with any pickup
+        self._days = {}
+        self._build_tables()
+
+    @classmethod
+    def from_file(cls, fn: str, digest: str = None):
+        """snapshot (.muellcal) or csv"""
+        if fn.endswith('.muellcal'):
+            categories, districts, records = read_snapshot(fn)
+            return cls(categories, records, districts=districts, digest=digest)
+        categories, records = events_from_wide(read_calendar_csv(fn))
+        return cls(categories, records, digest=digest)
+
+    def _build_tables(self):
+        """split the records per district once and
+        combine them for all 8x5 district pairs"""
+
+        days = self.records['day'].astype('datetime64[D]')
+        per_district = {}
+        for di, bezirk in enumerate(self.districts):
+            of_district = self.records['district'] == di
+            per_district[bezirk] = [np.unique(days[of_district & (self.records['category'] == ci)])
+                                    for ci in range(len(self.categories))]
+
+        for rm in RESTMUELL_BEZIRKE:
+            for rec in RECYCLING_BEZIRKE:
+                pickups = {k: np.union1d(per_district[rm][ci], per_district[rec][ci])
+                           for ci, k in enumerate(self.categories)}
+                self._pickups[(rm, rec)] = pickups
+                self._days[(rm, rec)] = np.unique(np.concatenate(list(pickups.values())))
+
+    def pickups(self, rm: str, rec: str) -> dict:
+        """{Kategorie: sorted array of days} for one district pair"""
+        return self._pickups[(rm, rec)]
+
+    def pickup_days(self, rm: str, rec: str) -> np.ndarray:
+        """sorted array of all days with a pickup for one district pair"""
+        return self._days[(rm, rec)]
+
+    # all lookups below are binary searches over the sorted arrays
+    def categories_on(self, day, rm: str, rec: str) -> list:
+        """categories picked up on day for one district pair"""
+        day = np.datetime64(day, 'D')
+        found = []
+        for k, days in self._pickups[(rm, rec)].items():
+            i = np.searchsorted(days, day)
+            if i < len(days) and days[i] == day:
+                found.append(k)
+        return found
+
+    def next_pickup(self, rm: str, rec: str, lookday: datetime):
+        """first day with a pickup at or after lookday, None if there is none"""
+        days = self._days[(rm, rec)]
+        i = np.searchsorted(days, ceil_day(lookday))
+        if i < len(days):
+            return days[i]
+        return None
+
+    def diff(self, other) -> dict:
+        """{(RM_bezirk, REC_bezirk): sorted array of days} with a different
+        set of categories in other, only district pairs with changes"""
+        changed = {}
+        for pair, pickups in self._pickups.items():
+            other_pickups = other._pickups.get(pair, {})
+            days = [np.setxor1d(pickups.get(k, NO_DAYS), other_pickups.get(k, NO_DAYS))
+                    for k in set(pickups) | set(other_pickups)]
+            days = np.unique(np.concatenate(days)) if days else NO_DAYS
+            if len(days):
+                changed[pair] = days
+        return changed
+
+    def pickups_between(self, rm: str, rec: str, start, end) -> dict:
+        """{day: [Kategorie, ...]} for all pickups in [start, end), sorted by day"""
+        start, end = ceil_day(start), ceil_day(end)
+        found = {}
+        for k, days in self._pickups[(rm, rec)].items():
+            i, j = np.searchsorted(days, [start, end])
+            for day in days[i:j]:
+                found.setdefault(day, []).append(k)
+        return dict(sorted(found.items()))
+
+
+class CalendarStore:
+    """Process wide holder of the current Calendar.
+
+    get() is cheap (one os.stat) and returns the current Calendar.
+    If the file changed on disk, the new version is loaded completely
+    and then swapped in with a single assignment, so no thread ever
+    sees a half loaded calendar.
+    Callbacks registered with on_reload are called with (old, new)
+    after every swap, old is None for the first load.
+    A file that does not parse is logged once and not read again until it
+    changes, the calendar loaded before stays in use."""
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        self._calendar = None
+        self._stat = None # (mtime_ns, size) of the file in use, None while it is missing
+        self._bad = None  # (stat, digest, error) of a file that did not parse
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.loads = 0              # number of (re)loads
+        self.load_seconds = 0.0     # sum over all loads
+        self.last_load_seconds = None
+
+    def on_reload(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    @property
+    def loaded(self) -> bool:
+        return self._calendar is not None
+
+    def unload(self):
+        """drops the calendar, the next get() loads it again"""
+        with self._lock:
+            self._calendar = None
+            self._stat = None
+            self._bad = None
+
+    def get(self) -> Calendar:
+        try:
+            st = os.stat(self.fn)
+        except FileNotFoundError:
+            if self._calendar is None:
+                raise
+            with self._lock:
+                # warn once, until the file is back (reload sets _stat again)
+                if self._stat is not None:
+                    self._stat = None
+                    logger.warning("%s not found, keeping loaded calendar", self.fn)
+            return self._calendar
+
+        if self._calendar is not None and (st.st_mtime_ns, st.st_size) == self._stat:
+            return self._calendar
+        return self.reload()
+
+    def reload(self, force: bool = False) -> Calendar:
+        """(re)loads the file if its content changed, or always if force"""
+
+        # only one thread loads, the others wait and get the fresh result
+        with self._lock:
+            st = os.stat(self.fn)
+            stat = (st.st_mtime_ns, st.st_size)
+            if self._calendar is not None and stat == self._stat and not force:
+                return self._calendar
+            if self._bad is not None and stat == self._bad[0] and not force:
+                return self._keep()
+
+            digest = file_digest(self.fn)
+            if self._calendar is not None and digest == self._calendar.digest and not force:
+                # touched, but same content
+                self._stat = stat
+                self._bad = None
+                return self._calendar
+            if self._bad is not None and digest == self._bad[1] and not force:
+                self._bad = (stat,) + self._bad[1:]
+                return self._keep()
+
+            t0 = time.perf_counter()
+            try:
+                calendar = Calendar.from_file(self.fn, digest=digest)
+            except (ValueError, struct.error) as e:
+                self._bad = (stat, digest, str(e))
+                logger.error("Calendar %s (sha256 %s) could not be loaded, %s: %s", self.fn, digest[:12],
+                             "keeping the loaded one" if self._calendar is not None else "no calendar", e)
+                return self._keep()
+            self._bad = None
+            seconds = time.perf_counter() - t0
+            self.loads += 1
+            self.load_seconds += seconds
+            self.last_load_seconds = seconds
+            logger.info("Calendar %s loaded in %.1f ms (sha256 %s)",
+                        self.fn, seconds*1000, digest[:12])
+
+            # atomic swap
+            old, self._calendar = self._calendar, calendar
+            self._stat = stat
+            for callback in self._listeners:
+                callback(old, calendar)
+            return calendar
+
+    def _keep(self) -> Calendar:
+        """the calendar loaded before the bad file, raises ValueError if there is none"""
+        if self._calendar is None:
+            raise ValueError(f"{self.fn} could not be loaded: {self._bad[2]}")
+        # get() does not look at the bad file again until it changes
+        self._stat = self._bad[0]
+        return self._calendar
+
+
+class CalendarRegistry:
+    """All years found in directory (AK_{YEAR}_komplett.muellcal, or .csv
+    if there is no snapshot), one CalendarStore per year.
+
+    Has the same lookups as Calendar. A year is only loaded when a query
+    reaches into it, so next_pickup at the end of December simply continues
+    in the next year. Years before the current one are dropped again.
+    A file for a new year found while running is loaded right away, so the
+    on_reload callbacks hear about it (old None) like about a changed year.
+    get() checks the loaded years for changes and returns the registry."""
+
+    RESCAN = 60 # seconds between two looks at the directory
+
+    def __init__(self, directory: str = '.'):
+        self.directory = directory
+        self._stores = {}       # year -> CalendarStore
+        self._listeners = []    # shared by all stores
+        self._scanned = None    # time.monotonic() of the last scan
+        self._lock = threading.Lock()
+
+    def on_reload(self, callback):
+        """callback(old, new) after a year was (re)loaded, see CalendarStore"""
+        self._listeners.append(callback)
+        return callback
+
+    def scan(self) -> list:
+        """looks for calendar files, returns the years found"""
+        found = {}
+        for name in sorted(os.listdir(self.directory)):
+            m = CALENDAR_FILE.match(name)
+            if m and (m.group(2) == 'muellcal' or int(m.group(1)) not in found):
+                found[int(m.group(1))] = os.path.join(self.directory, name)
+
+        added = []
+        with self._lock:
+            for year, fn in found.items():
+                store = self._stores.get(year)
+                if store is None:
+                    store = self._stores[year] = CalendarStore(fn)
+                    store._listeners = self._listeners
+                    if self._scanned is not None:
+                        added.append(year)
+                elif store.fn != fn:
+                    # e.g. the snapshot appeared next to the csv, loaded on next use
+                    store.fn = fn
+                    store._stat = None
+            self._scanned = time.monotonic()
+
+        this_year = datetime.now().year
+        for year in added:
+            if year >= this_year:
+                logger.info("Calendar for %d added", year)
+                try:
+                    self._stores[year].get()
+                except (FileNotFoundError, ValueError):
+                    pass
+        return sorted(found)
+
+    def years(self) -> list:
+        if self._scanned is None or time.monotonic() - self._scanned > self.RESCAN:
+            self.scan()
+        return sorted(self._stores)
+
+    def year(self, year: int):
+        """Calendar of year, loaded on first use, None if there is no file for it"""
+        if year not in self.years():
+            return None
+        try:
+            return self._stores[year].get()
+        except FileNotFoundError:
+            logger.warning("Calendar for %d disappeared", year)
+            return None
+        except ValueError:
+            # logged by the store when the file was read
+            return None
+
+    def get(self):
+        """reloads changed years, drops past years, returns self"""
+        this_year = datetime.now().year
+        for year in self.years():
+            store = self._stores[year]
+            if year < this_year and store.loaded:
+                store.unload()
+                logger.info("Calendar %s unloaded", store.fn)
+            elif store.loaded:
+                store.get()
+        return self
+
+    @property
+    def loaded_years(self) -> list:
+        return [year for year, store in sorted(self._stores.items()) if store.loaded]
+
+    def stores(self) -> dict:
+        """{year: CalendarStore} of all years found so far"""
+        with self._lock:
+            return dict(sorted(self._stores.items()))
+
+    def categories_on(self, day, rm: str, rec: str) -> list:
+        calendar = self.year(year_of(day))
+        return calendar.categories_on(day, rm, rec) if calendar else []
+
+    def next_pickup(self, rm: str, rec: str, lookday: datetime):
+        """first day with a pickup at or after lookday, in this or a later year"""
+        first = year_of(ceil_day(lookday))
+        for year in self.years():
+            if year < first:
+                continue
+            calendar = self.year(year)
+            day = calendar.next_pickup(rm, rec, lookday) if calendar else None
+            if day is not None:
+                return day
+        return None
+
+    def pickups_between(self, rm: str, rec: str, start, end) -> dict:
+        """{day: [Kategorie, ...]} for all pickups in [start, end), over all years in between"""
+        start, end = ceil_day(start), ceil_day(end)
+        if end <= start:
+            return {}
+        found = {}
+        for year in range(year_of(start), year_of(end - np.timedelta64(1, 'D')) + 1):
+            calendar = self.year(year)
+            if calendar:
+                found.update(calendar.pickups_between(rm, rec, start, end))
+        return found
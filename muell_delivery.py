@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Nachrichten-Versand
+
+Outbound queue for messages that are not a direct answer to a button press
+(reminders, debug messages). All reminders fire at the same time, so sending
+them directly runs into Telegram's flood limits. The Outbox
+    - throttles with token buckets (global and per chat),
+    - waits on RetryAfter and retries network errors with backoff,
+    - merges messages for the same chat and key (e.g. all categories of
+      one pickup day) into a single message,
+    - keeps several requests in flight, the buckets alone set the pace,
+    - logs how long a burst took to drain,
+    - reports how late messages with a due time were sent (on_sent).
+Everything runs on the event loop of the Application, send() must be
+called from there.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from itertools import count
+
+from telegram.error import (BadRequest, NetworkError, RetryAfter,
+                            TelegramError, Forbidden)
+
+logger = logging.getLogger(__name__)
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+# messages per second, Telegram allows ~30, the rest is left for the answers
+# of the handlers (they do not go through the Outbox)
+GLOBAL_RATE = 20
+GLOBAL_BURST = 1        # tokens of the global bucket, no burst on top of the rate
+CHAT_RATE = 1           # messages per second in a private chat
+GROUP_RATE = 20 / 60    # messages per second in a group
+MAX_RETRIES = 5
+MAX_IN_FLIGHT = 32      # concurrent send_message requests
+
+
+class TokenBucket:
+    """rate tokens per second, at most capacity at once"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.t = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+    def delay(self, now: float) -> float:
+        """seconds until the next token is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Message:
+
+    def __init__(self, chat_id, text, key, render, parse_mode, due):
+        self.chat_id = chat_id
+        self.parts = []
+        self.key = key
+        self.render = render
+        self.parse_mode = parse_mode
+        self.retries = 0
+        self.not_before = 0
+        self.due = due      # time.time() the message was meant for, or None
+
+    def add(self, text, parts):
+        if self.render:
+            self.parts.extend(p for p in parts if p not in self.parts)
+        else:
+            self.parts.append(text)
+
+    def text(self) -> str:
+        if self.render:
+            return self.render(self.parts)
+        return "\n\n".join(self.parts)
+
+
+class Outbox:
+    """Rate limited send queue, worked off by one asyncio task."""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 group_rate: float = GROUP_RATE, max_retries: int = MAX_RETRIES,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self._global = TokenBucket(global_rate, capacity=GLOBAL_BURST)
+        self._chats = {}                # chat_id -> TokenBucket
+        self._pending = OrderedDict()   # (chat_id, key) -> _Message, oldest first
+        self._wakeup = None             # asyncio.Event, set on new messages
+        self._slots = None              # asyncio.Semaphore, max_in_flight
+        self._in_flight = {}            # running _deliver task -> _Message
+        self._paused_until = 0          # RetryAfter applies to the whole bot
+        self._task = None
+        self._unique = count()
+        self._listeners = []            # callback(chat_id, key, lag), see on_sent
+
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'coalesced': 0}
+        self._burst_start = None
+        self._burst_sent = 0
+        self.last_burst = None          # (messages, seconds) of the last drained burst
+
+    async def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._task = asyncio.create_task(self._run(), name="Outbox")
+
+    async def stop(self, timeout: float = 10):
+        """stops taking new messages from the queue, waits for the ones in flight"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight), timeout=timeout)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def set_global_rate(self, rate: float):
+        """e.g. the share of one worker when several processes send for the same bot"""
+        self._global = TokenBucket(rate, capacity=GLOBAL_BURST)
+
+    def pause(self, seconds: float):
+        """no sending for seconds, e.g. after a RetryAfter outside of the Outbox"""
+        self._paused_until = max(self._paused_until, time.monotonic() + float(seconds))
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def oldest_due(self):
+        """smallest due of the messages waiting or in flight, None if none has one"""
+        dues = [msg.due for msg in self._pending.values() if msg.due is not None]
+        dues += [msg.due for msg in self._in_flight.values() if msg.due is not None]
+        return min(dues, default=None)
+
+    def on_sent(self, callback):
+        """callback(chat_id, key, lag) after a message with a due time was sent,
+        lag is the number of seconds it was sent after due"""
+        self._listeners.append(callback)
+        return callback
+
+    def send(self, chat_id, text: str = None, key=None, parts=(), render=None, parse_mode='HTML',
+             due: float = None):
+        """queue a message.
+        Messages with the same chat_id and key that are still waiting are merged:
+        with render, the parts are collected and render(parts) builds the text,
+        otherwise the texts are joined.
+        due (time.time()) is when the message should have gone out, e.g. the reminder time."""
+
+        qkey = (chat_id, key if key is not None else ('unique', next(self._unique)))
+        msg = self._pending.get(qkey)
+        if msg is None:
+            msg = _Message(chat_id, text, key, render, parse_mode, due)
+            msg.add(text, parts)
+            self._pending[qkey] = msg
+            if self._burst_start is None:
+                self._burst_start = time.monotonic()
+                self._burst_sent = 0
+            if self._wakeup is not None:
+                self._wakeup.set()
+        else:
+            msg.add(text, parts)
+            if due is not None and (msg.due is None or due < msg.due):
+                msg.due = due
+            self.stats['coalesced'] += 1
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # negative chat_ids are groups/channels
+            rate = self.group_rate if int(chat_id) < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        return bucket
+
+    def _next_ready(self, now: float):
+        """oldest message that may be sent now -> (qkey, msg, wait)"""
+        wait = None
+        for qkey, msg in self._pending.items():
+            delay = max(msg.not_before - now, self._bucket(msg.chat_id).delay(now))
+            if delay <= 0:
+                return qkey, msg, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, None, wait
+
+    async def _sleep(self, wait):
+        """waits up to wait seconds (forever if None), returns early on new messages"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                await self._sleep(None)
+                continue
+
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._global.delay(now))
+            qkey = None
+            if wait <= 0:
+                qkey, msg, wait = self._next_ready(now)
+            if qkey is None:
+                await self._sleep(wait)
+                continue
+
+            await self._slots.acquire()
+            if self._pending.get(qkey) is not msg:
+                # merged or retried while waiting for a slot
+                self._slots.release()
+                continue
+            now = time.monotonic()
+            del self._pending[qkey]
+            self._global.take(now)
+            self._bucket(msg.chat_id).take(now)
+
+            task = asyncio.create_task(self._deliver(qkey, msg))
+            self._in_flight[task] = msg
+            task.add_done_callback(self._delivered)
+
+    def _delivered(self, task):
+        self._in_flight.pop(task, None)
+        self._slots.release()
+        if not self._pending and not self._in_flight and self._burst_start is not None:
+            self._burst_done()
+
+    async def _deliver(self, qkey, msg):
+        try:
+            await self.bot.send_message(chat_id=msg.chat_id, text=msg.text(), parse_mode=msg.parse_mode)
+        except RetryAfter as e:
+            logger.warning("Flood limit, pausing sending for %s s", e.retry_after)
+            self.pause(e.retry_after)
+            self._retry(qkey, msg)
+        except (BadRequest, Forbidden) as e:
+            # chat not found, bot blocked, ... no use to try again
+            self.stats['failed'] += 1
+            logger.warning("Message to %s not sent: %s", msg.chat_id, e)
+        except NetworkError as e:
+            # TimedOut is a NetworkError as well
+            msg.not_before = time.monotonic() + 2 ** msg.retries
+            if not self._retry(qkey, msg):
+                logger.error("Giving up on message to %s: %s", msg.chat_id, e)
+        except TelegramError as e:
+            self.stats['failed'] += 1
+            logger.warning("Message to %s not sent: %s", msg.chat_id, e)
+        else:
+            self.stats['sent'] += 1
+            self._burst_sent += 1
+            if msg.due is not None:
+                lag = time.time() - msg.due
+                for callback in self._listeners:
+                    callback(msg.chat_id, msg.key, lag)
+
+    def _retry(self, qkey, msg) -> bool:
+        """puts msg back in front of the queue, False if it ran out of retries"""
+        if msg.retries >= self.max_retries:
+            self.stats['failed'] += 1
+            return False
+        msg.retries += 1
+        self.stats['retried'] += 1
+        other = self._pending.get(qkey)
+        if other is not None:
+            # merged into while we tried to send
+            for part in other.parts:
+                msg.add(part, [part])
+        self._pending[qkey] = msg
+        self._pending.move_to_end(qkey, last=False)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def _burst_done(self):
+        seconds = time.monotonic() - self._burst_start
+        self.last_burst = (self._burst_sent, seconds)
+        self._burst_start = None
+        if self._burst_sent > 1:
+            logger.info("Outbox drained: %d messages in %.1f s", self._burst_sent, seconds)
+
+        # forget idle chats
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chats.items() if now - b.t > 60]:
+            del self._chats[chat_id]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+HTTP-Server
+
+Small stdlib HTTP servers in a background thread, for the parts that
+need no framework (fake Bot API for the load test, later metrics and
+calendar feeds). The webhook uses the server that comes with
+python-telegram-bot instead.
+"""
+
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """BaseHTTPRequestHandler that logs to logging (debug) instead of stderr"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_body(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, status: int, data, headers: dict = None):
+        self.send_body(status, json.dumps(data, ensure_ascii=False).encode(),
+                       "application/json", headers)
+
+
+def start_server(handler_class, host: str = "127.0.0.1", port: int = 0, name: str = "http"):
+    """ThreadingHTTPServer serving in a daemon thread, port 0 picks a free one.
+    Stop it with server.shutdown()"""
+
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=name, daemon=True)
+    thread.start()
+    logger.info("%s listening on http://%s:%d", name, *server.server_address[:2])
+    return server
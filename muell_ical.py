@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Kalender-Abo
+
+One iCalendar feed (RFC 5545) per district pair, so the pickups show up
+in the phone's calendar app:
+
+    http://<ical_listen>:<ical_port>/ical/3A.ics
+
+All 40 feeds are rendered at once from the loaded calendar and only
+rebuilt when one of the calendar files changed (refresh() compares the
+content hashes). The HTTP thread only hands out the finished bytes,
+with an ETag, so calendar apps polling the feed mostly get a 304.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from muell_calendar import RECYCLING_BEZIRKE, RESTMUELL_BEZIRKE
+from muell_http import QuietHandler, start_server
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/calendar; charset=utf-8"
+MAX_AGE = 3600 # seconds calendar apps may keep the feed without asking
+ALARM = "-PT4H" # all day events start at 0:00, so 20:00 the day before
+
+
+def feed_name(rm: str, rec: str) -> str:
+    """('3', 'A') -> '3A'"""
+    return f"{rm}{rec}"
+
+def ics_escape(text: str) -> str:
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def fold(line: str) -> str:
+    """lines longer than 75 octets are continued with CRLF + space"""
+    data = line.encode()
+    if len(data) <= 75:
+        return line
+    parts = []
+    while data:
+        cut = min(len(data), 75 if not parts else 74)
+        # do not split a utf-8 sequence
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode())
+        data = data[cut:]
+    return "\r\n ".join(parts)
+
+def render_feed(pickups: dict, rm: str, rec: str, stamp: datetime) -> bytes:
+    """VCALENDAR with one all day VEVENT per (day, Kategorie) of
+    pickups {Kategorie: sorted array of days}. stamp (the calendar file's
+    mtime) is used as DTSTAMP, so the same calendar gives the same bytes."""
+
+    dtstamp = stamp.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    name = f"Müllabfuhr Bez. {rm}|{rec}"
+    lines = ["BEGIN:VCALENDAR",
+             "VERSION:2.0",
+             "PRODID:-//muellbot//Abfuhrkalender//DE",
+             "CALSCALE:GREGORIAN",
+             "METHOD:PUBLISH",
+             f"X-WR-CALNAME:{ics_escape(name)}",
+             "X-WR-TIMEZONE:Europe/Berlin",
+             "REFRESH-INTERVAL;VALUE=DURATION:P1D",
+             "X-PUBLISHED-TTL:P1D"]
+    events = sorted((day, k) for k, days in pickups.items() for day in days.tolist())
+    for day, k in events:
+        uid = hashlib.sha1(k.encode()).hexdigest()[:8]
+        lines += ["BEGIN:VEVENT",
+                  f"UID:{day:%Y%m%d}-{feed_name(rm, rec)}-{uid}@muellbot",
+                  f"DTSTAMP:{dtstamp}",
+                  f"DTSTART;VALUE=DATE:{day:%Y%m%d}",
+                  f"DTEND;VALUE=DATE:{day + timedelta(days=1):%Y%m%d}",
+                  f"SUMMARY:{ics_escape(k)}",
+                  f"DESCRIPTION:{ics_escape(f'{k}, Bez. {rm}|{rec}')}",
+                  "TRANSP:TRANSPARENT",
+                  "BEGIN:VALARM",
+                  "ACTION:DISPLAY",
+                  f"DESCRIPTION:{ics_escape(f'Morgen {k}')}",
+                  f"TRIGGER:{ALARM}",
+                  "END:VALARM",
+                  "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(fold(line) for line in lines) + "\r\n").encode()
+
+
+class FeedStore:
+    """the rendered feeds of all district pairs, {name: (body, etag)}"""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._feeds = {}
+        self._key = None    # ((year, digest), ...) the feeds were built from
+        self._lock = threading.Lock()
+        self.stats = {'200': 0, '304': 0, '404': 0}
+
+    def __len__(self) -> int:
+        return len(self._feeds)
+
+    def get(self, name: str):
+        """(body, etag) or None"""
+        return self._feeds.get(name)
+
+    def refresh(self) -> bool:
+        """renders all feeds again if a calendar of this or a later year
+        changed, True if they were rebuilt. Loads these years."""
+
+        this_year = datetime.now().year
+        calendars = {}
+        for year in self.registry.years():
+            if year >= this_year:
+                calendar = self.registry.year(year)
+                if calendar is not None:
+                    calendars[year] = calendar
+        key = tuple((year, calendar.digest) for year, calendar in calendars.items())
+
+        with self._lock:
+            if key == self._key:
+                return False
+            stores = self.registry.stores()
+            mtimes = [os.stat(stores[year].fn).st_mtime for year in calendars if os.path.exists(stores[year].fn)]
+            stamp = datetime.fromtimestamp(max(mtimes, default=0), timezone.utc)
+
+            feeds = {}
+            for rm in RESTMUELL_BEZIRKE:
+                for rec in RECYCLING_BEZIRKE:
+                    pickups = {}
+                    for calendar in calendars.values():
+                        for k, days in calendar.pickups(rm, rec).items():
+                            pickups[k] = np.concatenate([pickups[k], days]) if k in pickups else days
+                    body = render_feed(pickups, rm, rec, stamp)
+                    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+                    feeds[feed_name(rm, rec)] = (body, etag)
+
+            # one assignment, the HTTP threads see the old or the new feeds
+            self._feeds = feeds
+            self._key = key
+        logger.info("%d calendar feeds rendered for %s", len(feeds), sorted(calendars))
+        return True
+
+
+class FeedHandler(QuietHandler):
+    """GET /ical/<RM_bezirk><REC_bezirk>.ics with If-None-Match"""
+
+    feeds: FeedStore = None
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        name = path.rsplit('/', 1)[-1]
+        feed = None
+        if path.startswith('/ical/') and name.endswith('.ics'):
+            feed = self.feeds.get(name[:-len('.ics')].upper())
+        if feed is None:
+            self.feeds.stats['404'] += 1
+            self.send_body(404, b"not found\n", "text/plain")
+            return
+
+        body, etag = feed
+        headers = {'ETag': etag, 'Cache-Control': f"public, max-age={MAX_AGE}"}
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.feeds.stats['304'] += 1
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.feeds.stats['200'] += 1
+        self.send_body(200, body, CONTENT_TYPE, headers)
+
+    do_HEAD = do_GET
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match: "a", W/"b" or *"""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or any((t[2:] if t.startswith('W/') else t) == etag for t in tags)
+
+
+def serve(feeds: FeedStore, host: str = "127.0.0.1", port: int = 8080):
+    """serves the feeds in a background thread, returns the server"""
+
+    class Handler(FeedHandler):
+        pass
+    Handler.feeds = feeds
+    return start_server(Handler, host, port, name="ical")
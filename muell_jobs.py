@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Job-Verwaltung
+
+Index over the JobQueue (jobs by name, counted by kind for /debug and
+the metrics), a timing wheel for the per chat reminder times and an
+index of the chats by group (district pair).
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class JobRegistry:
+    """job name -> Job, kept in sync with the JobQueue, so the jobs can be
+    counted by kind without walking job_queue.jobs().
+
+    All jobs have to be created through the registry."""
+
+    def __init__(self, job_queue=None):
+        self.job_queue = job_queue
+        self._jobs = {}     # name -> Job
+        self._lock = threading.RLock()
+
+    def set_job_queue(self, job_queue):
+        self.job_queue = job_queue
+
+    def kinds(self) -> dict:
+        """{callback name: number of jobs}"""
+        with self._lock:
+            kinds = {}
+            for job in self._jobs.values():
+                kind = getattr(job.callback, '__qualname__', repr(job.callback))
+                kinds[kind] = kinds.get(kind, 0) + 1
+            return kinds
+
+    def _add(self, job):
+        with self._lock:
+            old = self._jobs.get(job.name)
+            if old is not None and old is not job:
+                # same name scheduled twice, only the newest one stays
+                old.schedule_removal()
+            self._jobs[job.name] = job
+        return job
+
+    def _forget(self, name: str, job):
+        with self._lock:
+            if self._jobs.get(name) is job:
+                del self._jobs[name]
+
+    def run_once(self, callback, when, name: str, **kwargs):
+        """like JobQueue.run_once, the job is forgotten once it ran"""
+
+        async def run_and_forget(context, *args, **kw):
+            try:
+                return await callback(context, *args, **kw)
+            finally:
+                self._forget(name, context.job)
+        run_and_forget.__name__ = callback.__name__
+        run_and_forget.__qualname__ = callback.__qualname__
+
+        with self._lock:
+            job = self.job_queue.run_once(run_and_forget, when=when, name=name, **kwargs)
+            return self._add(job)
+
+    def run_repeating(self, callback, interval, name: str, **kwargs):
+        with self._lock:
+            job = self.job_queue.run_repeating(callback, interval=interval, name=name, **kwargs)
+            return self._add(job)
+
+
+class ChatGroups:
+    """chat_id -> group (e.g. the district pair) and back, so the chats of
+    a few groups are found without walking all chats"""
+
+    def __init__(self):
+        self._members = {}  # group -> set of chat_ids
+        self._group = {}    # chat_id -> group
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._group)
+
+    def set(self, chat_id, group):
+        """puts chat_id in group, moves it if it was in another one"""
+        with self._lock:
+            self._discard(chat_id)
+            self._group[chat_id] = group
+            self._members.setdefault(group, set()).add(chat_id)
+
+    def discard(self, chat_id):
+        with self._lock:
+            self._discard(chat_id)
+
+    def _discard(self, chat_id):
+        group = self._group.pop(chat_id, None)
+        if group is not None:
+            members = self._members[group]
+            members.discard(chat_id)
+            if not members:
+                del self._members[group]
+
+    def chats(self, group) -> list:
+        with self._lock:
+            return list(self._members.get(group, ()))
+
+
+def minute_of_day(hhmm: str) -> int:
+    """'20:00' -> 1200"""
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+
+class TimingWheel:
+    """Reminder times of all chats in 1440 minute buckets.
+
+    One job ticks every minute and hands the chats of the bucket(s)
+    it passed to the coroutine callback(context, chat_ids, due), due is
+    the minute of the bucket (aware datetime). So the number of timers
+    does not grow with the number of chats or reminder times, and
+    moving a chat to another time is O(1)."""
+
+    MAX_CATCH_UP = 60 # minutes, after a longer stall old buckets are skipped
+
+    def __init__(self, tz, name: str = "reminder_wheel"):
+        self.callback = None
+        self.tz = tz
+        self.name = name
+        self._buckets = {}  # minute of day -> set of chat_ids
+        self._slot = {}     # chat_id -> minute of day
+        self._cursor = None # last minute that was handed out
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._resume = None # see resume
+
+    def __len__(self) -> int:
+        return len(self._slot)
+
+    def items(self) -> list:
+        """[(chat_id, minute of day), ...] of all chats"""
+        with self._lock:
+            return list(self._slot.items())
+
+    def slots(self) -> dict:
+        """{minute of day: number of chats}"""
+        with self._lock:
+            return {minute: len(chats) for minute, chats in sorted(self._buckets.items())}
+
+    def slot(self, chat_id):
+        """minute of day of chat_id, None if it is not in the wheel"""
+        return self._slot.get(chat_id)
+
+    def add(self, chat_id, minute: int):
+        """puts chat_id in the bucket of minute, moves it if it was somewhere else"""
+        with self._lock:
+            self._discard(chat_id)
+            self._slot[chat_id] = minute
+            self._buckets.setdefault(minute, set()).add(chat_id)
+
+    def add_many(self, chat_ids, minute: int):
+        """bulk add, e.g. when restoring all chats at startup"""
+        with self._lock:
+            bucket = self._buckets.setdefault(minute, set())
+            for chat_id in chat_ids:
+                if self._slot.get(chat_id) != minute:
+                    self._discard(chat_id)
+                    self._slot[chat_id] = minute
+                    bucket.add(chat_id)
+            if not bucket:
+                del self._buckets[minute]
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._discard(chat_id)
+
+    def _discard(self, chat_id):
+        minute = self._slot.pop(chat_id, None)
+        if minute is not None:
+            bucket = self._buckets[minute]
+            bucket.discard(chat_id)
+            if not bucket:
+                del self._buckets[minute]
+
+    @property
+    def cursor(self):
+        """last minute handed out (aware datetime), None before start"""
+        return self._cursor
+
+    def on_tick(self, callback):
+        """callback(cursor) after every tick, cursor is the last minute handed out"""
+        self._listeners.append(callback)
+        return callback
+
+    def resume(self, cursor):
+        """continue after cursor (aware datetime), the last minute handed out by an
+        earlier run: the minutes since then are handed out on the first tick
+        (at most MAX_CATCH_UP). Call before start, the latest cursor wins."""
+        if self._resume is None or cursor > self._resume:
+            self._resume = cursor
+
+    def start(self, jobs: JobRegistry, callback):
+        """starts ticking at the next full minute, the running minute (and
+        the missed ones, see resume) are handed out right away"""
+        self.callback = callback
+        now = datetime.now(timezone.utc)
+        first = 60 - now.second - now.microsecond / 1e6
+        minute = now.replace(second=0, microsecond=0)
+        self._cursor = minute - timedelta(minutes=1)
+        if self._resume is not None:
+            self._cursor = self._resume
+        jobs.run_repeating(self._tick, interval=60, first=first, name=self.name)
+        if self._cursor < minute:
+            # not at the next full minute, that one is the next bucket already
+            jobs.run_once(self._tick, when=0, name=f"{self.name}_catch_up")
+
+    async def _tick(self, context):
+        # cursor runs in UTC, the buckets are local time
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        if self._cursor is None or now - self._cursor > timedelta(minutes=self.MAX_CATCH_UP):
+            self._cursor = now - timedelta(minutes=1)
+
+        # every minute since the last tick, usually exactly one
+        while self._cursor < now:
+            self._cursor += timedelta(minutes=1)
+            local = self._cursor.astimezone(self.tz)
+            with self._lock:
+                chat_ids = list(self._buckets.get(local.hour * 60 + local.minute, ()))
+            if chat_ids:
+                await self.callback(context, chat_ids, self._cursor)
+        for listener in self._listeners:
+            listener(self._cursor)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Metriken
+
+Instrumentation of the hot paths in the Prometheus text format
+(https://prometheus.io/docs/instrumenting/exposition_formats/),
+served on a local HTTP endpoint:
+
+    curl http://127.0.0.1:9464/metrics
+
+Histograms are filled where things happen (handler latency, reminder lag).
+Everything that is already counted somewhere else (Outbox.stats, the
+message cache, the JobRegistry, the calendar loads) is read by collectors
+at scrape time, so the hot paths do not pay for it.
+"""
+
+import functools
+import logging
+import math
+import threading
+from time import perf_counter
+
+from muell_http import QuietHandler, start_server
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """cumulative buckets per label set, observe() from any thread"""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, callback, *labelvalues):
+        """wraps the coroutine function callback, every call is observed"""
+
+        @functools.wraps(callback)
+        async def timed(*args, **kwargs):
+            t0 = perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                self.observe(perf_counter() - t0, *labelvalues)
+        return timed
+
+    def lines(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in sorted(self._series.items())}
+        for labelvalues, counts in series.items():
+            labels = dict(zip(self.labels, labelvalues))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(dict(labels, le=format_value(float(bound))))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(counts[-2])}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+class Metrics:
+    """registry of histograms and collectors, render() gives the text format.
+
+    A collector is a function returning [(name, type, help, samples), ...]
+    with samples [(labels dict, value), ...] or a single value."""
+
+    def __init__(self):
+        self._histograms = []
+        self._collectors = []
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, labels, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def collector(self, callback):
+        self._collectors.append(callback)
+        return callback
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.lines())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception:
+                # one broken collector should not take down the endpoint
+                logger.exception("Metrics collector %s failed", getattr(collector, '__name__', collector))
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if not isinstance(samples, list):
+                    samples = [({}, samples)]
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(QuietHandler):
+    """GET /metrics"""
+
+    metrics: Metrics = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_body(404, b"not found\n", "text/plain")
+            return
+        self.send_body(200, self.metrics.render().encode(), CONTENT_TYPE)
+
+    do_HEAD = do_GET
+
+
+def serve(metrics: Metrics, host: str = "127.0.0.1", port: int = 9464):
+    """serves metrics in a background thread, returns the server (server.shutdown() stops it)"""
+
+    class Handler(MetricsHandler):
+        pass
+    Handler.metrics = metrics
+    return start_server(Handler, host, port, name="metrics")
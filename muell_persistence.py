@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Persistenz
+
+SQLite (WAL) backend for python-telegram-bot instead of PicklePersistence.
+    - one JSON row per chat/user, human readable with any sqlite client
+    - only rows whose content changed are written, the Application hands
+      over only the chats that had updates since the last flush
+    - chat_data/user_data are loaded lazily, on the first update of a chat
+      (refresh_chat_data), only preload_chats are read at startup
+    - one-shot migration from the old muellbot_pickle
+"""
+
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS chat_data_reminders ON chat_data (json_extract(data, '$.reminders_flag'));
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence backed by one SQLite file in WAL mode."""
+
+    def __init__(self, filename: str = "muellbot.sqlite",
+                 store_data: PersistenceInput = None,
+                 update_interval: float = 60,
+                 preload_chats: str = None):
+        """preload_chats: optional SQL condition on the json column `data`,
+        matching chats are loaded at startup (e.g. the ones with reminders on)"""
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filename = filename
+        self.preload_chats = preload_chats
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # last read/written json per id, so unchanged data is not written again,
+        # None = looked up, but not in the database
+        self._written = {'chat_data': {}, 'user_data': {}}
+        self._bot_data_json = None
+        self._conversations = {}
+
+    # --- helpers ---
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _load(self, table, id_col, key):
+        rows = self._query(f"SELECT data FROM {table} WHERE {id_col} = ?", (key,))
+        if not rows:
+            self._written[table][key] = None
+            return None
+        self._written[table][key] = rows[0][0]
+        return json.loads(rows[0][0])
+
+    def _refresh(self, table, id_col, key, data):
+        """loads the row into data on first use of key"""
+        if key in self._written[table]:
+            return
+        loaded = self._load(table, id_col, key)
+        if loaded:
+            data.update(loaded)
+
+    def _drop(self, table, id_col, key):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {table} WHERE {id_col} = ?", (key,))
+        self._written[table][key] = None
+
+    def _write(self, table, id_col, key, data):
+        dumped = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if self._written[table].get(key) == dumped:
+            return
+        with self._lock:
+            self._db.execute(f"INSERT INTO {table} ({id_col}, data) VALUES (?, ?) "
+                             f"ON CONFLICT({id_col}) DO UPDATE SET data = excluded.data",
+                             (key, dumped))
+        self._written[table][key] = dumped
+
+    # --- bot state outside of the chats ---
+    def get_meta(self, key: str, default: str = None) -> str:
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._db.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+    def write_chat_data(self, chat_id: int, data: dict):
+        """update_chat_data without waiting for the next flush of the Application"""
+        self._write('chat_data', 'chat_id', chat_id, data)
+
+    # --- BasePersistence ---
+    async def get_chat_data(self) -> dict:
+        chat_data = {}
+        if self.preload_chats:
+            t0 = time.perf_counter()
+            rows = self._query(f"SELECT chat_id, data FROM chat_data WHERE {self.preload_chats}")
+            for chat_id, data in rows:
+                self._written['chat_data'][chat_id] = data
+                chat_data[chat_id] = json.loads(data)
+            logger.info("%d chats preloaded from %s in %.1f ms",
+                        len(rows), self.filename, (time.perf_counter()-t0)*1000)
+        return chat_data
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        rows = self._query("SELECT data FROM bot_data WHERE id = 0")
+        if not rows:
+            return {}
+        self._bot_data_json = rows[0][0]
+        return json.loads(rows[0][0])
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        # the ConversationHandler needs all of them, states are small
+        conversations = {tuple(json.loads(key)): json.loads(state) for key, state in
+                         self._query("SELECT key, state FROM conversations WHERE name = ?", (name,))}
+        self._conversations[name] = dict(conversations)
+        return conversations
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        known = self._conversations.setdefault(name, {})
+        if known.get(key) == new_state:
+            return
+        with self._lock:
+            if new_state is None:
+                self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?",
+                                 (name, json.dumps(key)))
+            else:
+                self._db.execute("INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                                 "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state",
+                                 (name, json.dumps(key), json.dumps(new_state)))
+        known[key] = new_state
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self.write_chat_data(chat_id, data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._write('user_data', 'user_id', user_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        dumped = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if dumped == self._bot_data_json:
+            return
+        with self._lock:
+            self._db.execute("INSERT INTO bot_data (id, data) VALUES (0, ?) "
+                             "ON CONFLICT(id) DO UPDATE SET data = excluded.data", (dumped,))
+        self._bot_data_json = dumped
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop('chat_data', 'chat_id', chat_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop('user_data', 'user_id', user_id)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self._refresh('chat_data', 'chat_id', chat_id, chat_data)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._refresh('user_data', 'user_id', user_id, user_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # every change is already written, just fold the WAL back into the database
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # --- migration ---
+    def migrate_pickle(self, filename: str = "muellbot_pickle") -> bool:
+        """one-shot import of a single file PicklePersistence, False if done before or no file"""
+
+        if not os.path.exists(filename) or self._query("SELECT 1 FROM meta WHERE key = 'migrated_from'"):
+            return False
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+
+        with self._lock:
+            self._db.execute("BEGIN")
+            for chat_id, cd in (data.get('chat_data') or {}).items():
+                self._db.execute("INSERT OR REPLACE INTO chat_data VALUES (?, ?)",
+                                 (chat_id, json.dumps(cd, ensure_ascii=False, sort_keys=True)))
+            for user_id, ud in (data.get('user_data') or {}).items():
+                self._db.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)",
+                                 (user_id, json.dumps(ud, ensure_ascii=False, sort_keys=True)))
+            if data.get('bot_data'):
+                self._db.execute("INSERT OR REPLACE INTO bot_data VALUES (0, ?)",
+                                 (json.dumps(data['bot_data'], ensure_ascii=False, sort_keys=True),))
+            for name, conversations in (data.get('conversations') or {}).items():
+                for key, state in conversations.items():
+                    if state is not None:
+                        self._db.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                                         (name, json.dumps(key), json.dumps(state)))
+            self._db.execute("INSERT INTO meta VALUES ('migrated_from', ?)", (filename,))
+            self._db.execute("COMMIT")
+        logger.info("Migrated %d chats from %s to %s",
+                    len(data.get('chat_data') or {}), filename, self.filename)
+        return True
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Shards
+
+Supervisor for running the bot as N worker processes. Telegram hands
+out the updates to a single consumer (getUpdates or one webhook), so the
+supervisor receives them and routes every update by chat_id to the worker
+that owns the chat:
+
+    shard = chat_id % shards
+
+A chat always ends up in the same worker, so its chat_data, its
+conversation state and its reminder (the TimingWheel of that worker)
+live in exactly one process, and every reminder is sent once.
+All workers use the same SQLite file (WAL, one row per chat) and mmap
+the same calendar snapshot.
+
+Every start of a worker gets a fresh queue: a process killed inside
+Queue.get() never releases the queue's lock, and a successor reading
+from the same queue would wait for it forever. The supervisor keeps the
+updates a worker has not taken yet (Inbox confirms every update it hands
+out), so the restarted worker (same shard, same chats) continues with
+them and with the reminder minutes it missed, see cursor.
+"""
+
+import logging
+import multiprocessing
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+RESTART_DELAY = 1       # seconds before the first restart of a crashed worker
+MAX_RESTART_DELAY = 60  # doubles on every crash shortly after a start, up to this
+STABLE_AFTER = 60       # seconds a worker has to run before the delay is reset
+
+
+def shard_of(key: int, shards: int) -> int:
+    """0 <= shard < shards, also for negative (group) chat_ids"""
+    return int(key) % shards
+
+def shard_condition(column: str, index: int, shards: int) -> str:
+    """the same as shard_of in SQL (% keeps the sign in SQLite)"""
+    return f"(({column} % {shards}) + {shards}) % {shards} = {index}"
+
+def update_key(update) -> int:
+    """what an update is routed by: the chat, the user for inline queries,
+    otherwise the update_id (spreads chat-less updates over the workers)"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class Inbox:
+    """the worker's end of its queue, get() confirms the update it returns"""
+
+    def __init__(self, queue, taken):
+        self.queue = queue
+        self.taken = taken
+
+    def get(self, timeout: float = None):
+        """next update, None once the supervisor asks the worker to stop.
+        Raises queue.Empty after timeout seconds."""
+        item = self.queue.get(timeout=timeout)
+        if item is None:
+            return None
+        seq, data = item
+        # only this process writes it, the supervisor reads it
+        self.taken.value = seq
+        return data
+
+
+class _Worker:
+
+    def __init__(self, index: int, context):
+        self.index = index
+        self.queue = None   # new one on every start
+        self.routed = 0     # sequence number of the last update routed to the shard
+        self.taken = context.Value('q', 0, lock=False) # ... and of the last one the worker took
+        self.backlog = deque() # (seq, data) routed, not taken yet
+        # time.time() of the last reminder minute the shard handed out, survives restarts
+        # of the worker (the workers also keep it in the database for restarts of the supervisor)
+        self.cursor = context.Value('d', 0.0)
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.restart_at = None
+
+
+class Supervisor:
+    """starts target(index, shards, inbox, cursor, *args) in one process
+    per shard and keeps them running"""
+
+    def __init__(self, target, shards: int, args: tuple = ()):
+        self.target = target
+        self.shards = shards
+        self.args = args
+        # spawn: the workers start with a clean interpreter, no copied threads or sockets
+        self._context = multiprocessing.get_context('spawn')
+        self.workers = [_Worker(i, self._context) for i in range(shards)]
+        self.stats = {'routed': 0, 'restarts': 0}
+        self._stopping = False
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        return self
+
+    def _spawn(self, worker: _Worker):
+        old = worker.queue
+        if old is not None:
+            # whatever is left in it is in the backlog as well
+            old.cancel_join_thread()
+            old.close()
+        worker.queue = self._context.Queue()
+        self._confirmed(worker)
+        for item in worker.backlog:
+            worker.queue.put(item)
+        if worker.backlog:
+            logger.info("Worker %d gets %d updates again", worker.index, len(worker.backlog))
+
+        worker.process = self._context.Process(
+            target=self.target, name=f"shard-{worker.index}",
+            args=(worker.index, self.shards, Inbox(worker.queue, worker.taken), worker.cursor) + self.args)
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logger.info("Worker %d/%d started (pid %d)", worker.index, self.shards, worker.process.pid)
+
+    def route(self, data, key: int):
+        """hands data to the worker owning key"""
+        worker = self.workers[shard_of(key, self.shards)]
+        worker.routed += 1
+        item = (worker.routed, data)
+        worker.backlog.append(item)
+        worker.queue.put(item)
+        self.stats['routed'] += 1
+
+    @staticmethod
+    def _confirmed(worker: _Worker):
+        """drops the updates the worker took from the backlog"""
+        taken = worker.taken.value
+        while worker.backlog and worker.backlog[0][0] <= taken:
+            worker.backlog.popleft()
+
+    def check(self):
+        """restarts dead workers, with a growing delay if they keep crashing"""
+        if self._stopping:
+            return
+        now = time.monotonic()
+        for worker in self.workers:
+            self._confirmed(worker)
+            if worker.process.is_alive():
+                if now - worker.started > STABLE_AFTER:
+                    worker.delay = RESTART_DELAY
+                continue
+            if worker.restart_at is None:
+                worker.restart_at = now + worker.delay
+                logger.warning("Worker %d exited with %s, restarting in %d s (%d updates waiting)",
+                               worker.index, worker.process.exitcode, worker.delay, self.pending(worker))
+                if now - worker.started < STABLE_AFTER:
+                    worker.delay = min(worker.delay * 2, MAX_RESTART_DELAY)
+            elif now >= worker.restart_at:
+                worker.restarts += 1
+                self.stats['restarts'] += 1
+                self._spawn(worker)
+
+    @staticmethod
+    def pending(worker: _Worker) -> int:
+        """updates routed to the worker it did not take yet"""
+        return worker.routed - worker.taken.value
+
+    def stop(self, timeout: float = 30):
+        """asks the workers to finish (None in their queue), kills the ones that do not"""
+        self._stopping = True
+        for worker in self.workers:
+            worker.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning("Worker %d did not stop, terminating", worker.index)
+                worker.process.terminate()
+                worker.process.join(5)
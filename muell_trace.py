@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Trace-Log
+
+Structured event log instead of debug messages to DEV_ID and prints.
+event() only appends to a ring buffer and a queue, a QueueListener
+thread writes the events as JSON lines to a rotating file, so the
+event loop never waits for the disk (or for Telegram).
+
+    - levels as in logging, DEBUG events (one per chat) are sampled,
+      INFO and above are always kept
+    - every event is counted, sampled or not, for the summary
+    - warnings of all loggers end up in the ring buffer as well (event 'log')
+
+    tail -f muellbot_trace.jsonl | jq .
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+RING_SIZE = 1000
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 3
+
+
+class JSONFormatter(logging.Formatter):
+    """the event dict in record.msg as one json line"""
+
+    def format(self, record) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # same process, the dict is formatted by the listener thread
+        return record
+
+
+class TraceLogHandler(logging.Handler):
+    """puts log records (warnings and up) into the tracer"""
+
+    def __init__(self, tracer, level=logging.WARNING):
+        super().__init__(level)
+        self.tracer = tracer
+
+    def emit(self, record):
+        try:
+            self.tracer.event('log', level=record.levelno, logger=record.name, message=record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+
+class Tracer:
+
+    def __init__(self, level: int = logging.INFO, sample: float = 0.1, ring_size: int = RING_SIZE):
+        """level: events below are dropped, sample: share of DEBUG events that are kept"""
+        self.level = level
+        self.sample = sample
+        self.ring = deque(maxlen=ring_size) # last kept events, newest last
+        self.counts = {}                    # event -> [seen, kept]
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger("muellbot.trace")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.DEBUG)
+        self._listener = None
+        self._capture = None
+
+    def start(self, filename: str = None, max_bytes: int = MAX_BYTES, backups: int = BACKUPS):
+        """starts the writer thread (without filename only the ring buffer is kept)
+        and collects the warnings of all loggers"""
+        if filename:
+            q = queue.SimpleQueue()
+            handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                           backupCount=backups, encoding='utf-8')
+            handler.setFormatter(JSONFormatter())
+            self._listener = logging.handlers.QueueListener(q, handler)
+            self._listener.start()
+            self._logger.addHandler(_QueueHandler(q))
+        self._capture = TraceLogHandler(self)
+        logging.getLogger().addHandler(self._capture)
+        return self
+
+    def stop(self):
+        """writes the queued events and stops the writer thread"""
+        if self._capture:
+            logging.getLogger().removeHandler(self._capture)
+            self._capture = None
+        for handler in list(self._logger.handlers):
+            self._logger.removeHandler(handler)
+        if self._listener:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+
+    def event(self, name: str, level: int = logging.INFO, **fields) -> bool:
+        """records event name with fields, True if it was kept"""
+        with self._lock:
+            counts = self.counts.get(name)
+            if counts is None:
+                counts = self.counts[name] = [0, 0]
+            counts[0] += 1
+            if level < self.level or (level <= logging.DEBUG and random.random() >= self.sample):
+                return False
+            counts[1] += 1
+            record = {'ts': round(time.time(), 3), 'level': logging.getLevelName(level), 'event': name}
+            record.update(fields)
+            self.ring.append(record)
+        if self._listener:
+            self._logger.log(level, record)
+        return True
+
+    def recent(self, n: int = 10, min_level: int = logging.WARNING) -> list:
+        """newest n events of at least min_level, newest first"""
+        found = []
+        with self._lock:
+            for record in reversed(self.ring):
+                if logging.getLevelName(record['level']) >= min_level:
+                    found.append(record)
+                    if len(found) >= n:
+                        break
+        return found
+
+    def summary(self) -> dict:
+        """{event: (seen, kept)} since the start"""
+        with self._lock:
+            return {name: tuple(counts) for name, counts in sorted(self.counts.items())}
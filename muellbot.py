@@ -6,23 +6,47 @@ Muellbot
 
 TODO
     ✓ change to inline Keyboard... seems nicer in Groupchat... too many messages
-    ☐ add Setting for reminder time, instead of 20:00 fixed
-    ☐ fix parsing / dataframes for "special" Dates (D/E ohne Bez.)
-    ☐ (low prio) change from pickled persistence to json (safer + human readable)
+    ✓ add Setting for reminder time, instead of 20:00 fixed
+    ✓ fix parsing / dataframes for "special" Dates (D/E ohne Bez.)
+    ✓ (low prio) change from pickled persistence to json (safer + human readable)
 """
 
+import asyncio
+import html
 import logging
+import multiprocessing
+import os
+import re
+import secrets
+import signal
 # Data Manipulation
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from queue import Empty
+from time import perf_counter
+from urllib.parse import urlparse
 
-import pandas as pd
-from pytz import timezone
+import numpy as np
+from pytz import timezone, utc
 # python-telegram-bot
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
-                      ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
-from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, ConversationHandler, Filters,
-                          MessageHandler, PicklePersistence, Updater)
+from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InlineQueryResultsButton,
+                      InputTextMessageContent, ReplyKeyboardMarkup,
+                      ReplyKeyboardRemove, Update)
+from telegram.error import RetryAfter
+from telegram.ext import (Application, CallbackQueryHandler, CommandHandler,
+                          ContextTypes, ConversationHandler, InlineQueryHandler,
+                          MessageHandler, PersistenceInput, Updater, filters)
+
+from muell_calendar import (RECYCLING_BEZIRKE, RESTMUELL_BEZIRKE,
+                            CalendarRegistry, as_datetime)
+from muell_delivery import GLOBAL_RATE, Outbox
+from muell_ical import FeedStore, feed_name, serve as serve_feeds
+from muell_jobs import ChatGroups, JobRegistry, TimingWheel, minute_of_day
+from muell_metrics import Metrics, serve as serve_metrics
+from muell_persistence import SQLitePersistence
+from muell_shards import Supervisor, shard_condition, update_key
+from muell_trace import Tracer
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
@@ -34,26 +58,66 @@ DAYS_SHORT = ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']
 HELP_MSG =f"""Schau im Menü was der Bot alles kann. 😎
 /start um das Hauptmenü zu starten;
 kann auch helfen, falls der Bot unerwartet oder gar nicht reagiert.
+In jedem Chat: @Botname und Bezirk (z.B. 3A) eintippen für die nächsten Termine.
 """
+BUSY_MSG = "Gerade ist viel los, bitte gleich nochmal versuchen. /start"
 
-# turn debug mode on/off
+# turn debug mode on/off (per chat events in the trace log)
 global DEBUG
 DEBUG = True
 
 global TIMEZONEOFFSET, TIMEZONE, DATEFORMAT # use only where it matters => usually human reading
 TIMEZONE = timezone('Europe/Berlin')
 DATEFORMAT = "%d.%m.%Y"
+DEFAULT_REMINDER_TIME = "20:00" # the day before the pickup
+CALENDAR_CHECK = 300 # seconds between two looks at the calendar files
+INLINE_CACHE_TIME = 6 * 3600 # seconds Telegram may reuse inline results, at most until midnight
 
 # FILTERED_CSV = f'AK_{YEAR}_{RESTMUELL_BEZIRK}{RECYCLING_BEZIRK}-{BEZIRK}.csv'
-FULL_CSV = f'AK_2023_komplett.csv'
+# all AK_{YEAR}_komplett files in the working directory, shared by all handlers and jobs.
+# Years are loaded on first use and reloaded when the file changes,
+# the binary snapshot from parse_muell_pdf is preferred (mmap, no csv parsing)
+CALENDAR = CalendarRegistry('.')
+# index over the JobQueue (by name, counted by kind)
+JOBS = JobRegistry()
+# rate limited sending of reminders and debug messages
+OUTBOX = Outbox()
+# per chat reminder times, one tick per minute hands the due chats to send_reminders
+WHEEL = TimingWheel(TIMEZONE)
+# the same chats by district pair, for the corrections of calendar_changed
+SUBSCRIBERS = ChatGroups()
+# .ics feed per district pair, rebuilt when the calendar changes, see /ical
+FEEDS = FeedStore(CALENDAR)
+ICAL_URL = None # link base sent by /ical, set in start_services
+ICAL_ENDPOINT = None # (host, port) of the feed server of the first worker, see ical_available
+# HTTP endpoints of this process by name, see start_services
+SERVERS = {}
+# (index, number of workers) of this process, (0, 1) without workers, see muell_shards
+SHARD = (0, 1)
+DATABASE = "muellbot.sqlite"
+# Prometheus text on http://metrics_listen:metrics_port/metrics, the histograms are
+# filled by the handlers and the OUTBOX, everything else is read in collect_metrics
+METRICS = Metrics()
+HANDLER_LATENCY = METRICS.histogram("muellbot_handler_seconds", "Time spent in a handler.",
+                                    labels=("handler", "state"))
+# event log for debugging, written by a background thread, see /debug
+TRACE = Tracer(level=logging.DEBUG if DEBUG else logging.INFO)
+REMINDER_LAG = METRICS.histogram("muellbot_reminder_lag_seconds",
+                                 "Seconds between the reminder time and sending the reminder.",
+                                 buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
  
-MAIN_MENU, SETTINGS_MENU, RESTMUELL_SETTING, RECYCLING_SETTING, SETTINGS_DONE, RESTART = range(6)
+MAIN_MENU, SETTINGS_MENU, RESTMUELL_SETTING, RECYCLING_SETTING, SETTINGS_DONE, RESTART, REMINDER_TIME_SETTING = range(7)
+STATE_NAMES = {MAIN_MENU: 'MAIN_MENU', SETTINGS_MENU: 'SETTINGS_MENU', RESTMUELL_SETTING: 'RESTMUELL_SETTING',
+               RECYCLING_SETTING: 'RECYCLING_SETTING', SETTINGS_DONE: 'SETTINGS_DONE', RESTART: 'RESTART',
+               REMINDER_TIME_SETTING: 'REMINDER_TIME_SETTING'}
 
 main_menu_keyboard = [
     [InlineKeyboardButton("👏 Heute", callback_data='today'),
      InlineKeyboardButton("📅 Nächster Termin", callback_data='next')],
     [InlineKeyboardButton("🌇 Morgen", callback_data='tomorrow'),
      InlineKeyboardButton("⏰ auto. Erinnerungen", callback_data='reminders')],
+    [InlineKeyboardButton("🗓 Woche", callback_data='week'),
+     InlineKeyboardButton("📆 Monat", callback_data='month')],
     [InlineKeyboardButton("🔚 Schließen", callback_data='close'),
      InlineKeyboardButton("⚙ Einstellungen", callback_data='settings')]]
 main_menu_markup = InlineKeyboardMarkup(main_menu_keyboard)
@@ -61,82 +125,113 @@ main_menu_markup = InlineKeyboardMarkup(main_menu_keyboard)
 settings_keyboard = [
     [InlineKeyboardButton("Restmüllbezirk", callback_data='trash'),
      InlineKeyboardButton("♻ Recyclingbezirk", callback_data='recycling')],
-    [InlineKeyboardButton("🔙 Fertig", callback_data='done')]]
+    [InlineKeyboardButton("⏰ Erinnerungszeit", callback_data='reminder_time'),
+     InlineKeyboardButton("🔙 Fertig", callback_data='done')]]
 settings_markup = InlineKeyboardMarkup(settings_keyboard)
 
 restart_keyboard = [
     [InlineKeyboardButton("Start", callback_data='restart')]]
 restart_markup = InlineKeyboardMarkup(restart_keyboard)
 
-def filter_df(df, pat=r'', row=True, dropna=True):
-    """Returns whole rows with pat if row, 
-    and drop the rest if dropna.\\
-    Maybe sth. like this exists somewhere in pandas already?"""
-    
-    if row:
-        f = lambda row : row.str.contains(pat).any()
-    else:
-        f = lambda row : row.str.contains(pat)
-    filterframe = df.apply(f, axis=1)
-    if dropna and row:
-        return df.loc[filterframe]
-    elif dropna and not row: # drop as much na as possible
-        return df.where(filterframe).dropna(axis=0, how='all').dropna(axis=1, how='all')
-    else:
-        return df.where(filterframe)
+def get_day_info(lookday: datetime, calendar, rm_bez, rec_bez) -> list:
+    """categories picked up on lookday in district rm_bez|rec_bez"""
     
-def get_df(fn: str) -> pd.DataFrame:
-    try:
-        df = pd.read_csv(fn,
-                        index_col=0,
-                        keep_default_na=False,
-                        parse_dates=True,
-                        )
-    except FileNotFoundError:
-        message = f"Something went wrong..."
-        print(message)
-        
-    return df
+    return calendar.categories_on(lookday.date(), rm_bez, rec_bez)
 
-def get_day_info(lookday: datetime, df) -> pd.Series:
+def get_next_day(calendar, rm_bez, rec_bez, lookday=None):
+    """take calendar and get next pickup day from today or lookday"""
     
-    lookdate = lookday.date()
-    if lookdate in df.index.date:
-        return df.loc[str(lookdate)]
-    else:
-        return pd.Series()
+    if not lookday:
+        lookday =  datetime.today()
+    next_day = calendar.next_pickup(rm_bez, rec_bez, lookday)
+    if next_day is None:
+        # after the last pickup of the last known year
+        return None, []
+    next_day = as_datetime(next_day)
+    return next_day, get_day_info(next_day, calendar, rm_bez, rec_bez)
 
-def get_next_day(df, lookday=None):
-    """take df and get next row from today or lookday"""
+def get_range_info(calendar, rm_bez, rec_bez, days, lookday=None) -> dict:
+    """take calendar and get all pickups of the next days (incl. today or lookday)"""
     
     if not lookday:
-        lookday =  datetime.today()
-    diff_df = df.index-lookday
-    return df.loc[diff_df >= timedelta(days=0)].iloc[0]
+        lookday = datetime.today()
+    first_day = lookday.date()
+    return calendar.pickups_between(rm_bez, rec_bez, first_day, first_day + timedelta(days=days))
 
-def format_day_info(day_info, pat) -> str:
+def format_day_info(day, categories) -> str:
     """Takes day's infos and makes a pretty string output.
     """
     global DATEFORMAT
     
-    filter_func = lambda s, pat : s.loc[s.str.contains(pat)]
+    if day is None:
+        return "Kein weiterer Termin im Abfuhrkalender."
+    
     # make header (Weekday + Date)
-    timestamp = day_info.name
-    r_date = timestamp.strftime(DATEFORMAT)
-    r_weekday = DAYS[timestamp.weekday()]
+    r_date = day.strftime(DATEFORMAT)
+    r_weekday = DAYS[day.weekday()]
     header = f"<b>{r_weekday}, {r_date}</b>\n"
-    r_info = filter_func(day_info, pat)
     
     message = ""
-    if r_info.empty:
+    if not categories:
         message = f"Nichts relevantes gefunden."        
     else:
-        for k in r_info.index.values:
+        for k in categories:
             message += f"{k} "
                 
     return header+message
+
+# kind -> (days, title) of the range messages
+RANGES = {
+    'week': (7, "Die nächsten 7 Tage"),
+    'month': (30, "Die nächsten 30 Tage"),
+}
+
+@lru_cache(maxsize=1024)
+def render_message(kind, day, rm_bez, rec_bez) -> str:
+    """rendered HTML message of kind 'day', 'next', 'week', 'month' or 'reminder'
+    for day (a date) and one district pair.
+    There are only 40 district pairs, so most chats get a cached string.
+    Cleared when a calendar year is (re)loaded, see clear_message_cache."""
     
-def start(update: Update, context: CallbackContext) -> int:
+    calendar = CALENDAR.get()
+    lookday = datetime.combine(day, time())
+    if kind == 'day':
+        return format_day_info(lookday, get_day_info(lookday, calendar, rm_bez, rec_bez))
+    if kind == 'next':
+        # from tomorrow on, like the lookup before the cache (now is past 0:00 of today)
+        return format_day_info(*get_next_day(calendar, rm_bez, rec_bez, lookday + timedelta(days=1)))
+    if kind == 'reminder':
+        return format_reminder(lookday, rm_bez, rec_bez, calendar.categories_on(day, rm_bez, rec_bez))
+    days, title = RANGES[kind]
+    return format_range_info(get_range_info(calendar, rm_bez, rec_bez, days, lookday), title)
+
+@CALENDAR.on_reload
+def clear_message_cache(old, new):
+    # also for a year that was added or loaded (old None): 'next', 'week', 'month'
+    # and the inline results reach into the next year at the end of December
+    info = render_message.cache_info()
+    if not info.currsize and not inline_results.cache_info().currsize:
+        return # first load at startup, nothing cached yet
+    render_message.cache_clear()
+    inline_results.cache_clear()
+    logger.info("Message cache cleared after calendar load (%d entries, %d hits, %d misses)",
+                info.currsize, info.hits, info.misses)
+
+def format_range_info(range_info, title) -> str:
+    """Takes {day: categories} and makes a pretty string output, one line per day.
+    """
+    
+    header = f"<b>{title}</b>\n"
+    if not range_info:
+        return header + "Nichts relevantes gefunden."
+    
+    lines = []
+    for day, categories in range_info.items():
+        day = as_datetime(day)
+        lines.append(f"{DAYS_SHORT[day.weekday()]}, {day.strftime(DATEFORMAT)}: {', '.join(categories)}")
+    return header + "\n".join(lines)
+    
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     # query = update.callback_query
     chat_keys = context.chat_data.keys()
@@ -145,16 +240,16 @@ def start(update: Update, context: CallbackContext) -> int:
         context.chat_data['reminders_flag'] = False
         
     if 'RM_bezirk' not in chat_keys or 'REC_bezirk' not in chat_keys:
-        update.message.reply_text('Zuerst Restmuellbezirk und Recyclingbezirk einstellen',
+        await update.message.reply_text('Zuerst Restmuellbezirk und Recyclingbezirk einstellen',
                                   reply_markup=settings_markup)
         return SETTINGS_MENU
     
-    update.message.reply_text('Hi 👋👋\nWas hättest du gerne?', reply_markup=main_menu_markup)
+    await update.message.reply_text('Hi 👋👋\nWas hättest du gerne?', reply_markup=main_menu_markup)
     return MAIN_MENU
 
-def restart(update: Update, context: CallbackContext) -> int:
+async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
 
     chat_keys = context.chat_data.keys()
     
@@ -163,18 +258,18 @@ def restart(update: Update, context: CallbackContext) -> int:
         context.chat_data['reminders_flag'] = False
         
     if 'RM_bezirk' not in chat_keys or 'REC_bezirk' not in chat_keys:
-        query.edit_message_text('Zuerst Restmuellbezirk und Recyclingbezirk einstellen',
+        await query.edit_message_text('Zuerst Restmuellbezirk und Recyclingbezirk einstellen',
                                   reply_markup=settings_markup)
         return SETTINGS_MENU
     
-    query.edit_message_text('Hi 👋👋\nWas hättest du gerne?', reply_markup=main_menu_markup)
+    await query.edit_message_text('Hi 👋👋\nWas hättest du gerne?', reply_markup=main_menu_markup)
     return MAIN_MENU
 
 
-def settings(update: Update, context: CallbackContext) -> int:
+async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     
-    query.answer()
+    await query.answer()
     cdk = context.chat_data.keys()
     if 'RM_bezirk' in cdk and 'REC_bezirk' in cdk:
         message = f"Einstellungen: \nRestmuellbezirk: {context.chat_data['RM_bezirk']}\
@@ -183,36 +278,37 @@ def settings(update: Update, context: CallbackContext) -> int:
         message = f"Einstellungen: \nRestmuellbezirk: {context.chat_data['RM_bezirk']}\nRecyclingbezirk: N/A"
     elif 'REC_bezirk' in cdk:
         message = f"Einstellungen: \nRestmuellbezirk: N/A\nRecyclingbezirk: N/A"
+    message += f"\nErinnerungszeit: {context.chat_data.get('reminder_time', DEFAULT_REMINDER_TIME)} (am Vortag)"
         
-    query.edit_message_text(
+    await query.edit_message_text(
             text=message+"\nEinstellung wählen:",
             reply_markup=settings_markup)
         
     return SETTINGS_MENU
 
-def settings_done(update: Update, context: CallbackContext) -> int:
+async def settings_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     # reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard = True)
     cdk = context.chat_data.keys()
     if 'RM_bezirk' in cdk and 'REC_bezirk' in cdk:
-        query.edit_message_text(
+        await query.edit_message_text(
             f"Einstellungen: \nRestmuellbezirk: {context.chat_data['RM_bezirk']}\
                 \nRecyclingbezirk: {context.chat_data['REC_bezirk']}",
             reply_markup=main_menu_markup)
     elif 'RM_bezirk' in cdk:
-        query.edit_message_text(
+        await query.edit_message_text(
             f"Einstellungen: \nRestmuellbezirk: {context.chat_data['RM_bezirk']}\nRecyclingbezirk: N/A",
             reply_markup=main_menu_markup)
     elif 'REC_bezirk' in cdk:
-        query.edit_message_text(
+        await query.edit_message_text(
             f"Einstellungen: \nRestmuellbezirk: N/A\nRecyclingbezirk: N/A",
             reply_markup=main_menu_markup)
     return MAIN_MENU
 
-def select_restmuellbezirk(update: Update, context: CallbackContext):
+async def select_restmuellbezirk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    query.answer()
+    await query.answer()
     keyboard_restmuell = [
         [InlineKeyboardButton('1', callback_data='1'),
          InlineKeyboardButton('2', callback_data='2'),
@@ -224,12 +320,12 @@ def select_restmuellbezirk(update: Update, context: CallbackContext):
          InlineKeyboardButton('8', callback_data='8')]]
     
     reply_markup = InlineKeyboardMarkup(keyboard_restmuell)
-    query.edit_message_text('RESTMUELLBEZIRK:', reply_markup=reply_markup)    
+    await query.edit_message_text('RESTMUELLBEZIRK:', reply_markup=reply_markup)    
     return RESTMUELL_SETTING
 
-def select_recyclingbezirk(update: Update, context: CallbackContext):
+async def select_recyclingbezirk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    query.answer()
+    await query.answer()
     keyboard_recycling = [
         [InlineKeyboardButton('A', callback_data='A'),
          InlineKeyboardButton('B', callback_data='B'),
@@ -238,295 +334,694 @@ def select_recyclingbezirk(update: Update, context: CallbackContext):
          InlineKeyboardButton('E', callback_data='E')]]
     
     reply_markup = InlineKeyboardMarkup(keyboard_recycling)
-    query.edit_message_text('RECYCLINGBEZIRK (Papier, Gelber Sack):',
+    await query.edit_message_text('RECYCLINGBEZIRK (Papier, Gelber Sack):',
                               reply_markup=reply_markup)
     return RECYCLING_SETTING
 
-def set_restmuellbezirk(update: Update, context: CallbackContext):
+async def set_restmuellbezirk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    query.answer()
+    await query.answer()
     context.chat_data['RM_bezirk'] = query.data
-    query.edit_message_text(f'Restmüllbezirk eingestellt: {query.data}\nWeitere Einstellungen?',
+    if context.chat_data.get('reminders_flag'):
+        subscribe(query.message.chat_id, context.chat_data)
+    await query.edit_message_text(f'Restmüllbezirk eingestellt: {query.data}\nWeitere Einstellungen?',
                               reply_markup=settings_markup)
     return SETTINGS_MENU
 
-def set_recyclingbezirk(update: Update, context: CallbackContext):
+async def set_recyclingbezirk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    query.answer()
+    await query.answer()
     context.chat_data['REC_bezirk'] = query.data
-    query.edit_message_text(f'Recyclingbezirk eingestellt: {query.data}\nWeitere Einstellungen?',
+    if context.chat_data.get('reminders_flag'):
+        subscribe(query.message.chat_id, context.chat_data)
+    await query.edit_message_text(f'Recyclingbezirk eingestellt: {query.data}\nWeitere Einstellungen?',
+                              reply_markup=settings_markup)
+    return SETTINGS_MENU
+
+async def select_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    # 16:00 - 23:30 in half hours, 4 per row
+    times = [f"{h:02d}:{m:02d}" for h in range(16, 24) for m in (0, 30)]
+    keyboard_times = [[InlineKeyboardButton(t, callback_data=t) for t in times[i:i+4]]
+                      for i in range(0, len(times), 4)]
+    
+    reply_markup = InlineKeyboardMarkup(keyboard_times)
+    await query.edit_message_text('ERINNERUNGSZEIT (am Tag vor der Abholung):',
+                              reply_markup=reply_markup)
+    return REMINDER_TIME_SETTING
+
+async def set_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    context.chat_data['reminder_time'] = query.data
+    if context.chat_data.get('reminders_flag'):
+        subscribe(query.message.chat_id, context.chat_data)
+    await query.edit_message_text(f'Erinnerungszeit eingestellt: {query.data}\nWeitere Einstellungen?',
                               reply_markup=settings_markup)
     return SETTINGS_MENU
 
-def heute(update: Update, context: CallbackContext) -> int:
+async def heute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send today's info."""
     query = update.callback_query
-    query.answer()
+    await query.answer()
     
     cd = context.chat_data
     if 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
         rm_bez = cd['RM_bezirk']
         rec_bez = cd['REC_bezirk']
-        pat = fr"Bez. {rm_bez}|Bez. {rec_bez}|{rec_bez} "
     
         # fetch data
         today = datetime.today()
-        df = get_df(FULL_CSV)
+        CALENDAR.get() # reloads (and clears the message cache) if the file changed
             
         # pack message
-        message = format_day_info(get_day_info(today, df), pat=pat)
-        query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+        message = render_message('day', today.date(), rm_bez, rec_bez)
+        await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
     else:
-        query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
+        await query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
         
     return MAIN_MENU
 
-def morgen(update: Update, context: CallbackContext) -> int:
+async def morgen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send tomorrow's info."""
     query = update.callback_query
-    query.answer()
+    await query.answer()
     
     cd = context.chat_data
     if 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
         rm_bez = cd['RM_bezirk']
         rec_bez = cd['REC_bezirk']
-        pat = fr"Bez. {rm_bez}|Bez. {rec_bez}|{rec_bez} "
     
         # fetch data
         today = datetime.today()
         tomorrow = today + timedelta(days=1)
-        df = get_df(FULL_CSV)
+        CALENDAR.get()
 
         # pack & send message
-        message = format_day_info(get_day_info(tomorrow, df), pat=pat)
-        query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+        message = render_message('day', tomorrow.date(), rm_bez, rec_bez)
+        await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
     else:
-        query.edit_message_text(text="Bitte Einstellungen anpassen", parse_mode='HTML', reply_markup=main_menu_markup)
+        await query.edit_message_text(text="Bitte Einstellungen anpassen", parse_mode='HTML', reply_markup=main_menu_markup)
         
     return MAIN_MENU
 
-def next_date(update: Update, context: CallbackContext):
+async def next_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     cd = context.chat_data
     if 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
         rm_bez = cd['RM_bezirk']
         rec_bez = cd['REC_bezirk']
-        pat = fr"Bez. {rm_bez}|Bez. {rec_bez}|{rec_bez} "
-        df = filter_df(get_df(FULL_CSV), pat=pat)
-        message = format_day_info(get_next_day(df), pat=pat)
+        CALENDAR.get()
+        message = render_message('next', datetime.today().date(), rm_bez, rec_bez)
     
         if update.callback_query:
             query = update.callback_query
-            query.answer()
-            query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+            await query.answer()
+            await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
             return MAIN_MENU
         else:
-            context.bot.send_message(chat_id=update.message.chat_id,
+            await context.bot.send_message(chat_id=update.message.chat_id,
                                     text=message,
                                     parse_mode='HTML')
     else:
         if update.callback_query:
             query = update.callback_query
-            query.answer()
-            query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
+            await query.answer()
+            await query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
             return MAIN_MENU
         else:
-            context.bot.send_message(chat_id=update.message.chat_id,
+            await context.bot.send_message(chat_id=update.message.chat_id,
                                     text="Bitte Einstellungen anpassen. /start",
                                     parse_mode='HTML')
             
-def send_reminder(context: CallbackContext, message = ''):
+async def range_info(update: Update, context: ContextTypes.DEFAULT_TYPE, kind):
+    """Send all pickups of the next days (RANGES[kind]), used by woche and monat."""
     
-    reminders_flag = context.job.context['chat_data']['reminders_flag']
-    if reminders_flag:
-        context.bot.send_message(chat_id=context.job.context['chat_id'],
-                                 text=message,
-                                 parse_mode='HTML')
+    cd = context.chat_data
+    if 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
+        rm_bez = cd['RM_bezirk']
+        rec_bez = cd['REC_bezirk']
+        CALENDAR.get()
+        message = render_message(kind, datetime.today().date(), rm_bez, rec_bez)
+    
+        if update.callback_query:
+            query = update.callback_query
+            await query.answer()
+            await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+            return MAIN_MENU
+        else:
+            await context.bot.send_message(chat_id=update.message.chat_id,
+                                    text=message,
+                                    parse_mode='HTML')
     else:
-        pass
+        if update.callback_query:
+            query = update.callback_query
+            await query.answer()
+            await query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
+            return MAIN_MENU
+        else:
+            await context.bot.send_message(chat_id=update.message.chat_id,
+                                    text="Bitte Einstellungen anpassen. /start",
+                                    parse_mode='HTML')
 
-def schedule_reminders(context: CallbackContext, 
-                       lookahead = 30, # days to look ahead and schedule
-                       reminder_time = 20, # int of hour when reminders get sent (the day before)
-                       ):
-    """schedules new reminders and removes scheduled reminders if reminders_flag==False"""
-    
-    global DEBUG, DEV_ID
-    j_chat_data = context.job.context['chat_data']
-    reminders_flag = j_chat_data['reminders_flag']
-    chat_id = context.job.context['chat_id']
+async def woche(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the pickups of the next 7 days."""
+    return await range_info(update, context, 'week')
 
+async def monat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the pickups of the next 30 days."""
+    return await range_info(update, context, 'month')
+
+# '3A', '3 a', '3|A', 'A3', ...
+INLINE_PAIR = re.compile(r'^\s*(?:([1-8])\s*[|/,\-]?\s*([A-Ea-e])|([A-Ea-e])\s*[|/,\-]?\s*([1-8]))\s*$')
+# kind of render_message -> title of the inline result
+INLINE_KINDS = {
+    'next': "📅 Nächster Termin",
+    'tomorrow': "🌇 Morgen",
+    'week': "🗓 Woche",
+}
+
+def parse_pair(text: str):
+    """'3A' -> ('3', 'A'), None if text is no district pair"""
+    m = INLINE_PAIR.match(text or '')
+    if m is None:
+        return None
+    rm, rec = (m.group(1), m.group(2)) if m.group(1) else (m.group(4), m.group(3))
+    return rm, rec.upper()
+
+@lru_cache(maxsize=128)
+def inline_results(rm_bez, rec_bez, day) -> tuple:
+    """the inline results of one district pair on day, built from the message cache.
+    Cleared together with it on calendar reload."""
     
-    rm_bez = j_chat_data['RM_bezirk']
-    rec_bez = j_chat_data['REC_bezirk']
-    pat = fr"Bez. {rm_bez}|Bez. {rec_bez}|{rec_bez} "
-    
-    today = datetime.today()
-    df = filter_df(get_df(FULL_CSV), pat=pat)
+    results = []
+    for kind, title in INLINE_KINDS.items():
+        if kind == 'tomorrow':
+            message = render_message('day', day + timedelta(days=1), rm_bez, rec_bez)
+        else:
+            message = render_message(kind, day, rm_bez, rec_bez)
+        # plain text preview of the message
+        description = re.sub(r'<[^>]+>', '', message).strip().replace("\n", " · ")
+        results.append(InlineQueryResultArticle(
+            id=f"{kind}-{rm_bez}{rec_bez}-{day:%Y%m%d}",
+            title=f"{title} (Bez. {rm_bez}|{rec_bez})",
+            description=description[:200],
+            input_message_content=InputTextMessageContent(message, parse_mode='HTML')))
+    return tuple(results)
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """@bot 3A in any chat: next pickup, tomorrow and this week of the district pair.
+    Needs no chat_data, the results are the same for everyone and are cached
+    by Telegram until INLINE_CACHE_TIME or midnight, whatever comes first."""
     
-    diff_df = df.index-today
-    future_df = df.loc[(diff_df < timedelta(days=lookahead)) & (diff_df >= timedelta(days=0))]    
-    filter_func = lambda s, pat : s.loc[s.str.contains(pat)]
+    query = update.inline_query
+    now = datetime.now(TIMEZONE)
+    midnight = TIMEZONE.localize(datetime.combine(now.date() + timedelta(days=1), time()))
+    cache_time = max(60, min(INLINE_CACHE_TIME, int((midnight - now).total_seconds())))
     
-    if DEBUG:
-        jobs = context.job_queue.jobs()
-        jobdict = {j.name: [j.next_t, j.context] for j in jobs}
-        print('-------------------JOBS-------------------')
-        print(jobdict)
-        print('------------------------------------------')
+    pair = parse_pair(query.query)
+    if pair is None or pair[0] not in RESTMUELL_BEZIRKE or pair[1] not in RECYCLING_BEZIRKE:
+        await query.answer([], cache_time=INLINE_CACHE_TIME,
+                           button=InlineQueryResultsButton("Bezirk eingeben, z.B. 3A", start_parameter="inline"))
+        return
     
-    if reminder_time < 24:
-        first_call = timedelta(days=1)-timedelta(hours = reminder_time)
-    else:
-        first_call = timedelta(days=1)-timedelta(hours = 20)
-        
-    # todo 
-    # maybe for future version: Fragen ob Müll raus, sonst last call
-    # reminder_time = 22
-    # last_call = timedelta(days=1)-timedelta(hours=reminder_time)
-    
-    mdict = {}
-    for col in future_df.columns:
-        mdict[col] = filter_func(future_df[col], pat=pat).index.to_pydatetime()
-        
-    # k = Kategorie, aka Restmüll/Papiermüll, ...
-    for k, dates in mdict.items():
-        for datum in dates:
-            
-            new_jobname = "reminder_"+str(k)+"_"+str(chat_id)
-            jobs = context.job_queue.jobs()
-            jobdict = {j.name: [j.next_t, j.context] for j in jobs}
+    CALENDAR.get()
+    await query.answer(inline_results(*pair, now.date()), cache_time=cache_time)
             
-            # schedule one reminder per category k
-            when = (datum-first_call)
-            localwhen = TIMEZONE.localize(when)
-            message = f"""<i>⏰ Erinnerung ⏰</i>
+def format_reminder(datum, rm_bez, rec_bez, categories) -> str:
+    """one reminder for all categories picked up on datum"""
+    
+    kategorien = "\n".join(f"<b>{k}</b>" for k in categories)
+    return f"""<i>⏰ Erinnerung ⏰</i>
 Heute noch rausstellen:
-<b>{k}</b>
+{kategorien}
 (Abholung: {DAYS_SHORT[datum.weekday()]}, {datum.strftime('%d.%m.%Y')}, \
-Bez. {j_chat_data['RM_bezirk']}|{j_chat_data['REC_bezirk']})"""
-            if new_jobname in jobdict.keys():
-                pass
-            else:
-                context.job_queue.run_once(send_reminder,
-                                    when = localwhen,
-                                    context = context.job.context,
-                                    name = new_jobname,
-                                    job_kwargs={'kwargs':
-                                        {'message': message}},
-                                    )
-                if DEBUG:
-                    context.bot.send_message(chat_id=DEV_ID,parse_mode='HTML',
-                        text=f"Message scheduled\nWhen:\n{localwhen}\
-                            \nMessage:\n{message}\nJobname: {new_jobname}\nContext: {j_chat_data}")
-    return None
-
-def set_reminders(update: Update, context: CallbackContext) -> int:
+Bez. {rm_bez}|{rec_bez})"""
+
+def reminder_minute(cd) -> int:
+    """minute of day when this chat wants its reminders"""
+    return minute_of_day(cd.get('reminder_time', DEFAULT_REMINDER_TIME))
+
+def subscribe(chat_id, cd):
+    """chat with reminders on (and both districts set): into the WHEEL at its
+    reminder time and into SUBSCRIBERS by district pair, moves it if it was there"""
+    WHEEL.add(chat_id, reminder_minute(cd))
+    SUBSCRIBERS.set(chat_id, (cd['RM_bezirk'], cd['REC_bezirk']))
+
+def unsubscribe(chat_id):
+    WHEEL.remove(chat_id)
+    SUBSCRIBERS.discard(chat_id)
+
+async def send_reminders(context: ContextTypes.DEFAULT_TYPE, chat_ids, due=None):
+    """called by the WHEEL with the chats whose reminder time (due) is now.
+    Looks up the pickups of the day after due once per district pair and queues
+    the reminders, the text comes from the message cache, a reminder queued twice
+    for the same chat and day is sent once by the OUTBOX. Chats that already got
+    the reminder of that day (a minute handed out again after a restart, see
+    reminders_done) are skipped."""
+    
+    # from due, not the clock: a 23:30 bucket caught up after midnight is still for the day after 23:30
+    day = (due.astimezone(TIMEZONE) if due else datetime.now(TIMEZONE)).date()
+    datum = datetime.combine(day + timedelta(days=1), time())
+    due = due.timestamp() if due else None
+    calendar = CALENDAR.get()
+    chat_data = context.application.chat_data
+    
+    pickups = {} # (RM_bezirk, REC_bezirk) -> categories
+    queued = 0
+    for chat_id in chat_ids:
+        cd = chat_data.get(chat_id, {})
+        if not cd.get('reminders_flag') or 'RM_bezirk' not in cd or 'REC_bezirk' not in cd:
+            continue
+        if cd.get('reminded') == datum.date().isoformat():
+            continue
+        pair = (cd['RM_bezirk'], cd['REC_bezirk'])
+        if pair not in pickups:
+            pickups[pair] = calendar.categories_on(datum, *pair)
+        if pickups[pair]:
+            OUTBOX.send(chat_id, key=('reminder', datum),
+                        parts=[render_message('reminder', datum.date(), *pair)], render="\n\n".join, due=due)
+            TRACE.event('reminder', logging.DEBUG, chat_id=chat_id, pair=f"{pair[0]}|{pair[1]}")
+            queued += 1
+            
+    TRACE.event('reminders_queued', queued=queued, chats=len(chat_ids), pairs=len(pickups),
+                pickup=datum.date().isoformat())
+
+def reminders_done(minute):
+    """the last reminder minute up to the WHEEL cursor (minute) whose reminders
+    all left the OUTBOX, a successor hands out the unfinished ones again
+    (send_reminders skips the chats that got theirs, see reminder_delivered)"""
+    
+    oldest = OUTBOX.oldest_due()
+    if oldest is not None:
+        minute = min(minute, datetime.fromtimestamp(oldest, utc) - timedelta(minutes=1))
+    return minute
+
+def save_reminder_cursor(application: Application, minute):
+    """keeps reminders_done(minute) in the database, post_init resumes from it"""
+    application.persistence.set_meta(f"reminder_cursor_{SHARD[0]}_{SHARD[1]}",
+                                     str(reminders_done(minute).timestamp()))
+
+def reminder_delivered(application: Application, chat_id, datum):
+    """OUTBOX.on_sent for reminders: the pickup day goes into the chat's row
+    right away, not with the next flush, so a successor does not send it again"""
+    cd = application.chat_data.get(chat_id)
+    if cd is None:
+        return
+    cd['reminded'] = datum.date().isoformat()
+    application.persistence.write_chat_data(chat_id, cd)
+
+@OUTBOX.on_sent
+def reminder_sent(chat_id, key, lag):
+    if key and key[0] == 'reminder':
+        REMINDER_LAG.observe(lag)
+
+def schedule_reminders(chat_data) -> dict:
+    """bulk (re)build of the WHEEL from chat_data, e.g. at startup:
+    every chat with reminders on goes into the bucket of its reminder time.
+    Returns {(RM_bezirk, REC_bezirk): number of chats}"""
+    
+    t0 = perf_counter()
+    
+    # group by district pair and reminder time, then fill the buckets at once
+    groups = {}
+    for chat_id, cd in list(chat_data.items()):
+        if cd.get('reminders_flag') and 'RM_bezirk' in cd and 'REC_bezirk' in cd:
+            pair = (cd['RM_bezirk'], cd['REC_bezirk'])
+            groups.setdefault((pair, reminder_minute(cd)), []).append(chat_id)
+    
+    per_pair = {}
+    for (pair, minute), chat_ids in groups.items():
+        WHEEL.add_many(chat_ids, minute)
+        for chat_id in chat_ids:
+            SUBSCRIBERS.set(chat_id, pair)
+        per_pair[pair] = per_pair.get(pair, 0) + len(chat_ids)
+    
+    ms = (perf_counter()-t0)*1000
+    logger.info("Reminders restored for %d chats (%d district pairs, %d times) in %.1f ms",
+                sum(per_pair.values()), len(per_pair), len(WHEEL.slots()), ms)
+    TRACE.event('reminders_restored', chats=sum(per_pair.values()), ms=round(ms, 1),
+                slots={f"{m // 60:02d}:{m % 60:02d}": n for m, n in WHEEL.slots().items()},
+                pairs={f"{rm}|{rec}": n for (rm, rec), n in sorted(per_pair.items())})
+    return per_pair
+
+def format_correction(datum, rm_bez, rec_bez) -> str:
+    """notice for chats that already got tomorrow's reminder (or none) from the old calendar"""
+    
+    text = render_message('reminder', datum.date(), rm_bez, rec_bez)
+    if not CALENDAR.categories_on(datum, rm_bez, rec_bez):
+        text = f"""<i>⏰ Erinnerung ⏰</i>
+Morgen ({DAYS_SHORT[datum.weekday()]}, {datum.strftime(DATEFORMAT)}) doch keine Abholung, \
+Bez. {rm_bez}|{rec_bez}"""
+    return "<b>Korrektur, der Abfuhrkalender wurde geändert:</b>\n" + text
+
+def calendar_changed(old, new):
+    """CALENDAR.on_reload callback: finds the district pairs whose pickup days
+    changed. Reminders are looked up when they are sent, so only chats in these
+    pairs whose reminder for tomorrow already went out need a correction.
+    They are queued once the reload is done (queue_corrections), not while
+    the calendar is locked."""
+    
+    if old is None:
+        return
+    t0 = perf_counter()
+    changed = old.diff(new)
+    if not changed:
+        logger.info("Calendar reloaded, no pickup day changed")
+        return
+    
+    now = datetime.now(TIMEZONE)
+    datum = datetime.combine(now.date() + timedelta(days=1), time())
+    tomorrow = datum.date()
+    # pairs where tomorrow is one of the changed days
+    affected = {pair for pair, days in changed.items()
+                if np.datetime64(tomorrow, 'D') in days}
+    
+    if affected:
+        try:
+            asyncio.get_running_loop().call_soon(queue_corrections, affected, datum)
+        except RuntimeError:
+            queue_corrections(affected, datum)
+    
+    logger.info("Calendar changed for %d district pairs (%s), %d with tomorrow, in %.1f ms",
+                len(changed), ", ".join(f"{rm}|{rec}: {len(days)} days" for (rm, rec), days in sorted(changed.items())),
+                len(affected), (perf_counter()-t0)*1000)
+    TRACE.event('calendar_changed', pairs=len(changed), affected=len(affected))
+
+def queue_corrections(affected, datum):
+    """corrections for the subscribers of the affected district pairs
+    whose reminder time for datum has passed"""
+    
+    now = datetime.now(TIMEZONE)
+    minute = now.hour * 60 + now.minute
+    corrected = 0
+    for pair in affected:
+        for chat_id in SUBSCRIBERS.chats(pair):
+            slot = WHEEL.slot(chat_id)
+            if slot is not None and slot <= minute:
+                OUTBOX.send(chat_id, key=('correction', datum), parts=[format_correction(datum, *pair)],
+                            render="\n\n".join)
+                corrected += 1
+    logger.info("%d corrections queued for %d district pairs", corrected, len(affected))
+    TRACE.event('corrections_queued', corrections=corrected, pairs=len(affected))
+
+async def watch_calendar(context: ContextTypes.DEFAULT_TYPE):
+    """regular check for new or changed calendar files, so a corrected
+    calendar is applied without waiting for the next request"""
+    CALENDAR.get()
+    if SERVERS.get('ical'):
+        FEEDS.refresh()
+
+def calendar_feeds_stale(old, new):
+    """CALENDAR.on_reload callback: rebuild the feeds once the current handler
+    is done, not in the middle of the reload"""
+    if not SERVERS.get('ical'):
+        return
+    try:
+        asyncio.get_running_loop().call_soon(FEEDS.refresh)
+    except RuntimeError:
+        pass # not running yet, post_init builds them
+
+async def set_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     query = update.callback_query
-    query.answer()
+    await query.answer()
     
     chat_id = query.message.chat_id
     cd = context.chat_data
     if 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
         rm_bez = cd['RM_bezirk']
         rec_bez = cd['REC_bezirk']
-        pat = fr"Bez. {rm_bez}|Bez. {rec_bez}|{rec_bez} "
         
         # set flag
         if context.chat_data['reminders_flag']:
             context.chat_data['reminders_flag'] = False
-            
-            # remove ALL! jobs for this chat,
-            # todo maybe only jobs containing "reminder" in future version
-            jobs = context.job_queue.jobs()
-            
-            for j in jobs:
-                if j.context['chat_id'] == chat_id:
-                    j.schedule_removal()
-                    # print(f"Job removed, {j.name}")
-                    if DEBUG:
-                        context.bot.send_message(chat_id=DEV_ID,parse_mode='HTML',\
-                            text=f"Job REMOVED: {j.name}")
-                        
+            unsubscribe(chat_id)
+            TRACE.event('reminders_off', logging.DEBUG, chat_id=chat_id)
             message = "Erinnerungen in diesem Chat sind jetzt AUS."
-            query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+            await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
             return None
         
         else:
             context.chat_data['reminders_flag'] = True
             message = "Erinnerungen in diesem Chat sind jetzt AN."
             message += f"\nBezirk: {rm_bez}|{rec_bez}"
+            message += f"\nUm {cd.get('reminder_time', DEFAULT_REMINDER_TIME)} am Vortag"
+            subscribe(chat_id, cd)
+            TRACE.event('reminders_on', logging.DEBUG, chat_id=chat_id, pair=f"{rm_bez}|{rec_bez}",
+                        time=cd.get('reminder_time', DEFAULT_REMINDER_TIME))
             
-            # check/renew schedule every hour
-            scheduler_interval = 3600 # seconds
-            context.job_queue.run_repeating(schedule_reminders,
-                                            interval= scheduler_interval,
-                                            first=2,
-                                            context= {'chat_id': chat_id,
-                                                    'chat_data' : context.chat_data},
-                                            name=f"schedule_reminders_repeating_{chat_id}")
-            
-            query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
+            await query.edit_message_text(text=message, parse_mode='HTML', reply_markup=main_menu_markup)
             
     else:
-        query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
+        await query.edit_message_text(text="Bitte Einstellungen anpassen.", parse_mode='HTML', reply_markup=main_menu_markup)
         
     return MAIN_MENU
 
-def scheduled_jobs(update: Update, context: CallbackContext):
-    """Send scheduled jobs to chat_id DEV_ID"""
-    global DEV_ID
-    jobs = context.job_queue.jobs()
-    message = "<b>SCHEDULED JOBS:</b>\n"
-    if jobs:
-        for j in jobs:
-            message += f"<b>{j.name}</b>\n- Next Trigger: {j.next_t}\n- context: {j.context}\n\n"
+async def ical(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the link to the calendar feed of the chat's districts."""
+    
+    cd = context.chat_data
+    if not await ical_available():
+        message = "Kalender-Abo ist für diesen Bot nicht verfügbar."
+    elif 'RM_bezirk' in cd.keys() and 'REC_bezirk' in cd.keys():
+        rm_bez = cd['RM_bezirk']
+        rec_bez = cd['REC_bezirk']
+        message = f"Kalender-Abo für Bezirk {rm_bez}|{rec_bez}:\n{ICAL_URL}/{feed_name(rm_bez, rec_bez)}.ics\n\n" \
+                  "In der Kalender-App als Abonnement (per URL) hinzufügen, " \
+                  "geänderte Termine kommen dann von selbst."
     else:
-        message += "keine Jobs"
-        
-    if DEBUG:
-        context.bot.send_message(chat_id=DEV_ID,parse_mode='HTML',\
-            text= message)
+        message = "Bitte Einstellungen anpassen. /start"
+    await update.message.reply_text(message, disable_web_page_preview=True)
+
+async def ical_available() -> bool:
+    """ICAL_URL is set and the feed server is up, in this process or
+    (other workers) in the first worker"""
+    
+    if not ICAL_URL:
+        return False
+    if SHARD[0] == 0:
+        return bool(SERVERS.get('ical'))
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(*ICAL_ENDPOINT), 1)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Short status of the bot and the latest warnings from the trace log,
+    only in the dev_id chat of the config (see build_application)"""
+    
+    uptime = timedelta(seconds=int(datetime.now().timestamp() - TRACE.started))
+    stats = OUTBOX.stats
+    info = render_message.cache_info()
+    message = f"<b>DEBUG</b> (läuft seit {uptime})\n"
+    if SHARD[1] > 1:
+        message += f"<b>Worker:</b> {SHARD[0]} von {SHARD[1]}, nur die Chats dieses Workers\n"
+    message += f"<b>Versand:</b> {stats['sent']} gesendet, {stats['failed']} fehlgeschlagen, " \
+               f"{stats['retried']} wiederholt, {len(OUTBOX)} wartend\n"
+    message += f"<b>Erinnerungen:</b> {len(WHEEL)} Chats, {len(WHEEL.slots())} Zeiten\n"
+    message += "<b>Jobs:</b> " + ", ".join(f"{k}: {n}" for k, n in sorted(JOBS.kinds().items())) + "\n"
+    message += f"<b>Nachrichten-Cache:</b> {info.currsize} Einträge, {info.hits} Treffer, {info.misses} Fehlschläge\n"
+    message += f"<b>Kalender:</b> {CALENDAR.years()}, geladen: {CALENDAR.loaded_years}\n"
+    
+    message += "\n<b>Events</b> (gesehen/gespeichert):\n"
+    for name, (seen, kept) in TRACE.summary().items():
+        message += f"- {name}: {seen}/{kept}\n"
+    
+    warnings = TRACE.recent(5)
+    if warnings:
+        message += "\n<b>Letzte Warnungen:</b>\n"
+    for record in warnings:
+        at = datetime.fromtimestamp(record['ts'], TIMEZONE).strftime("%d.%m. %H:%M:%S")
+        text = record.get('message') or ", ".join(f"{k}={v}" for k, v in record.items()
+                                                  if k not in ('ts', 'level', 'event'))
+        message += f"- {at} {record['event']}: {html.escape(text[:200])}\n"
+    
+    await update.message.reply_text(message, parse_mode='HTML')
 
-def cancel(update: Update, context: CallbackContext) -> int:
+@METRICS.collector
+def collect_metrics() -> list:
+    """numbers that are counted anyway (OUTBOX, JOBS, WHEEL, message cache,
+    CALENDAR), read on every scrape. Called in the thread of the metrics server."""
+    
+    info = render_message.cache_info()
+    lookups = info.hits + info.misses
+    stores = CALENDAR.stores()
+    burst = OUTBOX.last_burst or (None, None)
+    return [
+        ("muellbot_outbox_messages_total", "counter", "Messages of the Outbox by result.",
+         [({'result': result}, n) for result, n in OUTBOX.stats.items()]),
+        ("muellbot_outbox_pending", "gauge", "Messages waiting in the Outbox.", len(OUTBOX)),
+        ("muellbot_outbox_in_flight", "gauge", "send_message requests running.", OUTBOX.in_flight),
+        ("muellbot_outbox_last_burst_messages", "gauge", "Messages in the last drained burst.", burst[0]),
+        ("muellbot_outbox_last_burst_seconds", "gauge", "Time it took to drain the last burst.", burst[1]),
+        ("muellbot_jobs", "gauge", "Jobs in the JobQueue by callback.",
+         [({'kind': kind}, n) for kind, n in sorted(JOBS.kinds().items())]),
+        ("muellbot_reminder_chats", "gauge", "Chats with reminders on by reminder time.",
+         [({'time': f"{m // 60:02d}:{m % 60:02d}"}, n) for m, n in WHEEL.slots().items()]),
+        # reset when the cache is cleared after a calendar reload
+        ("muellbot_message_cache_hits_total", "counter", "Message cache hits.", info.hits),
+        ("muellbot_message_cache_misses_total", "counter", "Message cache misses.", info.misses),
+        ("muellbot_message_cache_entries", "gauge", "Messages in the cache.", info.currsize),
+        ("muellbot_message_cache_hit_ratio", "gauge", "Hits per lookup since the cache was cleared.",
+         info.hits / lookups if lookups else None),
+        ("muellbot_calendar_loaded", "gauge", "1 if the calendar of the year is in memory.",
+         [({'year': year}, int(store.loaded)) for year, store in stores.items()]),
+        ("muellbot_calendar_loads_total", "counter", "Calendar (re)loads.",
+         [({'year': year}, store.loads) for year, store in stores.items()]),
+        ("muellbot_calendar_load_seconds_total", "counter", "Time spent (re)loading the calendar.",
+         [({'year': year}, store.load_seconds) for year, store in stores.items()]),
+        ("muellbot_calendar_last_load_seconds", "gauge", "Duration of the last calendar load.",
+         [({'year': year}, store.last_load_seconds) for year, store in stores.items()]),
+        ("muellbot_ical_feeds", "gauge", "Rendered calendar feeds.", len(FEEDS)),
+        ("muellbot_ical_requests_total", "counter", "Calendar feed requests by status.",
+         [({'status': status}, n) for status, n in FEEDS.stats.items()]),
+    ]
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     # maybe add something here later
     return MAIN_MENU
     
-def close_menu(update: Update, context: CallbackContext) -> int:
+async def close_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     # reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard = True)
-    query.edit_message_text("Tschau.\n", reply_markup=restart_markup)
+    await query.edit_message_text("Tschau.\n", reply_markup=restart_markup)
     return RESTART
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Errors of the handlers. Their answers do not go through the OUTBOX, during a
+    reminder burst they can hit the flood limit: the OUTBOX waits as well and
+    the chat gets a short note through it once the limit is over."""
+    
+    error = context.error
+    chat = update.effective_chat if isinstance(update, Update) else None
+    if isinstance(error, RetryAfter):
+        OUTBOX.pause(error.retry_after)
+        TRACE.event('flood_limit', logging.WARNING, retry_after=error.retry_after,
+                    chat_id=chat.id if chat else None)
+        if chat:
+            OUTBOX.send(chat.id, text=BUSY_MSG, key=('busy',))
+        return
+    logger.error("Exception while handling an update", exc_info=error)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays info on how to use the bot."""
-    update.message.reply_text(HELP_MSG)
+    await update.message.reply_text(HELP_MSG)
     
-def main() -> None:
-    """Run the bot."""
+COMMANDS = [
+    ("start", "Hauptmenü starten"),
+    ("next", "Nächster Mülltermin im eingestellten Bezirk"),
+    ("woche", "Alle Mülltermine der nächsten 7 Tage"),
+    ("monat", "Alle Mülltermine der nächsten 30 Tage"),
+    ("ical", "Abfuhrtermine als Kalender-Abo"),
+    ("help", "kleine Hilfe"),
+    ("reminders_toggle", "Automatische Erinnerungen in diesem Chat an/aus"),
+    ]
+
+async def post_init(application: Application) -> None:
+    """runs on the event loop once the persistence is loaded, before polling starts"""
     
-    # read config and store each line in config_dict
-    config_filename = "devbot.conf"
-    # config_filename = "muellbot.conf"
+    if SHARD[0] == 0:
+        await application.bot.set_my_commands(COMMANDS)
+    
+    # reminder times of all chats in one timing wheel, the JobQueue is not persisted,
+    # so rebuild it from the chats with reminders on (preloaded by the persistence)
+    schedule_reminders(application.chat_data)
+    JOBS.set_job_queue(application.job_queue)
+    # a restart or deploy continues with the reminder minutes missed while the bot was down
+    saved = application.persistence.get_meta(f"reminder_cursor_{SHARD[0]}_{SHARD[1]}")
+    if saved:
+        WHEEL.resume(datetime.fromtimestamp(float(saved), utc))
+    WHEEL.on_tick(lambda minute: save_reminder_cursor(application, minute))
+    
+    @OUTBOX.on_sent
+    def delivered(chat_id, key, lag):
+        if key and key[0] == 'reminder':
+            reminder_delivered(application, chat_id, key[1])
+    
+    WHEEL.start(JOBS, send_reminders)
+    
+    # apply corrected calendars live, see calendar_changed
+    CALENDAR.on_reload(calendar_changed)
+    CALENDAR.on_reload(calendar_feeds_stale)
+    if SERVERS.get('ical'):
+        FEEDS.refresh()
+    JOBS.run_repeating(watch_calendar, interval=CALENDAR_CHECK, first=CALENDAR_CHECK, name="calendar_watch")
+    
+    await OUTBOX.start(application.bot)
+
+async def post_shutdown(application: Application) -> None:
+    await OUTBOX.stop()
+    # the reminders still waiting in the OUTBOX are sent by the next start
+    if WHEEL.cursor is not None:
+        save_reminder_cursor(application, WHEEL.cursor)
+    
+def read_config(config_filename: str) -> dict:
+    """one 'key value' pair per line, empty lines and # comments are skipped"""
+    
+    config_dict = {
+        'token'         : None,
+        'dev_id'        : None,
+        # webhook mode if webhook_url is set, polling otherwise
+        'webhook_url'   : None,     # public https url Telegram posts to
+        'webhook_listen': '127.0.0.1',
+        'webhook_port'  : '8443',
+        'webhook_secret': None,     # X-Telegram-Bot-Api-Secret-Token, random if not set
+        'max_updates'   : '64',     # updates processed at the same time
+        'workers'       : '1',      # more than 1: one process per shard of the chats, see muell_shards
+        'base_url'      : None,     # other Bot API server, e.g. fake_telegram.py
+        'metrics_listen': '127.0.0.1',
+        'metrics_port'  : '9464',   # 'off' for no metrics endpoint
+        'ical_listen'   : '127.0.0.1',
+        'ical_port'     : '8080',   # 'off' for no calendar feeds
+        'ical_url'      : None,     # public url of /ical (reverse proxy), /ical is off without it
+        'trace_file'    : 'muellbot_trace.jsonl', # 'off' keeps the events in memory only
+        'trace_sample'  : '0.1',    # share of the per chat events written to the trace
+    }
     with open(config_filename) as f:
-        config_dict = {
-            'token'     : None,
-            'dev_id'    : None,
-        }
         for line in f.readlines():
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
             k, v = line.strip().split()
             if k.lower() in config_dict.keys():
                 config_dict[k.lower()] = v
-                
-    global DEV_ID
-    DEV_ID = config_dict['dev_id']
-    persistence = PicklePersistence(filename="muellbot_pickle")
+    return config_dict
+
+def build_application(config_dict: dict) -> Application:
+    """Application with persistence and all handlers, not started yet."""
     
-    updater = Updater(config_dict['token'], persistence=persistence)
-    dispatcher = updater.dispatcher
+    # json rows in sqlite, chats are loaded on first use,
+    # except the ones with reminders on (needed for the WHEEL)
+    preload = "json_extract(data, '$.reminders_flag') = 1"
+    index, shards = SHARD
+    if shards > 1:
+        # a worker only schedules the reminders of its own chats
+        preload += " AND " + shard_condition('chat_id', index, shards)
+    persistence = SQLitePersistence(filename=DATABASE,
+                                    store_data=PersistenceInput(user_data=False, callback_data=False),
+                                    preload_chats=preload)
+    persistence.migrate_pickle("muellbot_pickle")
+    
+    # handlers run concurrently on one event loop, a slow request
+    # no longer blocks the other chats, at most max_updates at once
+    builder = Application.builder()
+    if shards > 1:
+        # the supervisor gets the updates from Telegram, see serve_updates
+        builder.updater(None)
+    if config_dict['base_url']:
+        builder.base_url(config_dict['base_url'])
+    application = (builder
+                   .token(config_dict['token'])
+                   .persistence(persistence)
+                   .concurrent_updates(int(config_dict['max_updates']))
+                   .post_init(post_init)
+                   .post_shutdown(post_shutdown)
+                   .build())
 
     # Add conversation handler with predefined states:
     conv_handler = ConversationHandler(
@@ -536,6 +1031,8 @@ def main() -> None:
                 CallbackQueryHandler(heute, pattern = r"^today$"),
                 CallbackQueryHandler(next_date, pattern = r"^next$"),
                 CallbackQueryHandler(morgen, pattern = r"^tomorrow$"),
+                CallbackQueryHandler(woche, pattern = r"^week$"),
+                CallbackQueryHandler(monat, pattern = r"^month$"),
                 CallbackQueryHandler(set_reminders, pattern = r"^reminders$"),
                 CallbackQueryHandler(close_menu, pattern = r"^close$"),
                 CallbackQueryHandler(settings, pattern = r"^settings$"),
@@ -543,6 +1040,7 @@ def main() -> None:
             SETTINGS_MENU: [
                 CallbackQueryHandler(select_restmuellbezirk, pattern = r"^trash$"),
                 CallbackQueryHandler(select_recyclingbezirk, pattern = r"^recycling$"),
+                CallbackQueryHandler(select_reminder_time, pattern = r"^reminder_time$"),
                 CallbackQueryHandler(settings_done, pattern = r"^done$"),
             ],
             RESTMUELL_SETTING: [
@@ -551,6 +1049,9 @@ def main() -> None:
             RECYCLING_SETTING: [
                 CallbackQueryHandler(set_recyclingbezirk, pattern = r"^([A-E])$"), # Recyclingbezirke A-D
             ],
+            REMINDER_TIME_SETTING: [
+                CallbackQueryHandler(set_reminder_time, pattern = r"^([01]\d|2[0-3]):[0-5]\d$"),
+            ],
             RESTART: [
                 CallbackQueryHandler(restart, pattern = r"^restart$")
             ]
@@ -559,26 +1060,221 @@ def main() -> None:
         fallbacks=[CommandHandler("start", start)]
     )
     
-    dispatcher.add_handler(conv_handler)
-    dispatcher.add_handler(CommandHandler('start', start))
-    dispatcher.add_handler(CommandHandler('next', next_date))
-    dispatcher.add_handler(CommandHandler('help', help_command))
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('next', next_date))
+    application.add_handler(CommandHandler('woche', woche))
+    application.add_handler(CommandHandler('monat', monat))
+    application.add_handler(CommandHandler('ical', ical))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(CommandHandler('help', help_command))
+    if config_dict['dev_id']:
+        application.add_handler(CommandHandler('debug', debug, filters=filters.Chat(int(config_dict['dev_id']))))
+    application.add_error_handler(error_handler)
+    instrument_handlers(application)
+    return application
+
+def instrument_handlers(application: Application):
+    """wraps every handler callback, so its latency goes to HANDLER_LATENCY
+    (labels: callback name, conversation state)"""
     
-    COMMANDS = [
-    ("start", "Hauptmenü starten"),
-    ("next", "Nächster Mülltermin im eingestellten Bezirk"),
-    ("help", "kleine Hilfe"),
-    ("reminders_toggle", "Automatische Erinnerungen in diesem Chat an/aus"),
-    ]
+    def wrap(handlers, state):
+        for handler in handlers:
+            handler.callback = HANDLER_LATENCY.time(handler.callback, handler.callback.__name__, state)
+    
+    for group in application.handlers.values():
+        for handler in group:
+            if isinstance(handler, ConversationHandler):
+                wrap(handler.entry_points, 'entry')
+                for state, handlers in handler.states.items():
+                    wrap(handlers, STATE_NAMES.get(state, str(state)))
+                wrap(handler.fallbacks, 'fallback')
+            else:
+                wrap([handler], 'none')
+
+def start_endpoint(config_dict: dict, name: str, serve, data, offset: int = 0):
+    """serve(data, host, port) on {name}_listen:{name}_port + offset in a background thread,
+    None if it is off or the port is taken"""
+    
+    host, port = config_dict[f'{name}_listen'], config_dict[f'{name}_port']
+    if port == 'off':
+        return None
+    port = int(port) + offset
+    try:
+        return serve(data, host, port)
+    except OSError as e:
+        logger.warning("No %s endpoint on %s:%s: %s", name, host, port, e)
+        return None
+
+def start_services(config_dict: dict):
+    """settings from the config, this year's calendar, the HTTP endpoints
+    and the trace log of this process (the bot or one worker of SHARD)"""
+    
+    global ICAL_URL, ICAL_ENDPOINT
+    index, shards = SHARD
+    
+    # load this year's calendar at startup, later years follow on first use
+    if CALENDAR.year(datetime.today().year) is None:
+        logger.warning("No calendar for %d found, years: %s", datetime.today().year, CALENDAR.years())
     
-    dispatcher.bot.set_my_commands(COMMANDS)
+    # every worker has its own metrics port (metrics_port + index), the feeds come from the first one
+    SERVERS['metrics'] = start_endpoint(config_dict, 'metrics', serve_metrics, METRICS, offset=index)
+    if index == 0:
+        SERVERS['ical'] = start_endpoint(config_dict, 'ical', serve_feeds, FEEDS)
+    # only the public url is of any use in the chats, ical_listen is usually localhost
+    if config_dict['ical_port'] != 'off' and config_dict['ical_url']:
+        ICAL_URL = config_dict['ical_url'].rstrip('/')
+        ICAL_ENDPOINT = (config_dict['ical_listen'], int(config_dict['ical_port']))
+        if index == 0 and not SERVERS['ical']:
+            logger.warning("ical_url %s is not served, /ical is off", ICAL_URL)
     
-    # Start the Bot
-    updater.start_polling()
+    trace_file = None if config_dict['trace_file'] == 'off' else config_dict['trace_file']
+    if trace_file and shards > 1:
+        # one file per worker, the rotation is not safe across processes
+        root, ext = os.path.splitext(trace_file)
+        trace_file = f"{root}.shard{index}{ext}"
+    TRACE.sample = float(config_dict['trace_sample'])
+    TRACE.start(trace_file)
+    
+    if shards > 1:
+        # Telegram's flood limit is per bot, each worker gets its share
+        OUTBOX.set_global_rate(GLOBAL_RATE / shards)
+
+def stop_services():
+    for server in SERVERS.values():
+        if server:
+            server.shutdown()
+    SERVERS.clear()
+    TRACE.stop()
 
+def webhook_options(config_dict: dict) -> dict:
+    """arguments of run_webhook / Updater.start_webhook"""
+    
+    # Telegram pushes the updates to the embedded server (tornado),
+    # requests without the secret token are rejected with 403
+    return dict(listen=config_dict['webhook_listen'],
+                port=int(config_dict['webhook_port']),
+                url_path=urlparse(config_dict['webhook_url']).path.lstrip('/'),
+                webhook_url=config_dict['webhook_url'],
+                secret_token=config_dict['webhook_secret'] or secrets.token_urlsafe(32),
+                max_connections=min(int(config_dict['max_updates']), 100))
+
+def run_worker(index: int, shards: int, inbox, cursor, config_dict: dict):
+    """one worker process, started by the Supervisor: handles the updates of
+    the chats with chat_id % shards == index and sends their reminders"""
+    
+    # Ctrl-C reaches the whole process group, the supervisor stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global SHARD
+    SHARD = (index, shards)
+    start_services(config_dict)
+    
+    # a restarted worker continues with the reminder minutes its predecessor missed,
+    # after a restart of the whole supervisor post_init takes them from the database
+    if cursor.value:
+        WHEEL.resume(datetime.fromtimestamp(cursor.value, utc))
+    
+    @WHEEL.on_tick
+    def save_cursor(minute):
+        cursor.value = reminders_done(minute).timestamp()
+    
+    application = build_application(config_dict)
+    try:
+        asyncio.run(serve_updates(application, inbox))
+    finally:
+        stop_services()
+
+async def serve_updates(application: Application, inbox):
+    """runs the application without Updater, the updates come from the
+    supervisor (as dicts) until it sends None or is gone"""
+    
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    # only run_polling / run_webhook call these by themselves
+    await post_init(application)
+    await application.start()
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, inbox.get, 1)
+            except Empty:
+                if not multiprocessing.parent_process().is_alive():
+                    logger.warning("Supervisor is gone, stopping")
+                    break
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+def supervise(config_dict: dict):
+    """workers > 1: one process per shard of the chats, this process only
+    receives the updates (polling or webhook) and routes them by chat_id"""
+    
+    shards = int(config_dict['workers'])
+    # before the workers open the database
+    SQLitePersistence(filename=DATABASE).migrate_pickle("muellbot_pickle")
+    supervisor = Supervisor(run_worker, shards, args=(config_dict,)).start()
+    try:
+        asyncio.run(route_updates(config_dict, supervisor))
+    finally:
+        supervisor.stop()
+        logger.info("Supervisor stopped, %d updates routed, %d worker restarts",
+                    supervisor.stats['routed'], supervisor.stats['restarts'])
+
+async def route_updates(config_dict: dict, supervisor: Supervisor):
+    """gets the updates from Telegram and hands each one to its worker
+    until SIGINT or SIGTERM, restarts workers that died"""
+    
+    kwargs = {'base_url': config_dict['base_url']} if config_dict['base_url'] else {}
+    queue = asyncio.Queue()
+    updater = Updater(Bot(config_dict['token'], **kwargs), queue)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    async with updater:
+        if config_dict['webhook_url']:
+            await updater.start_webhook(**webhook_options(config_dict))
+        else:
+            await updater.start_polling()
+        checked = loop.time()
+        while not stop.is_set():
+            try:
+                update = await asyncio.wait_for(queue.get(), 1)
+                supervisor.route(update.to_dict(), update_key(update))
+            except asyncio.TimeoutError:
+                pass
+            if loop.time() - checked >= 1:
+                supervisor.check()
+                checked = loop.time()
+        await updater.stop()
+
+def main() -> None:
+    """Run the bot."""
+    
+    # read config and store each line in config_dict
+    config_dict = read_config("devbot.conf")
+    # config_dict = read_config("muellbot.conf")
+    
+    if int(config_dict['workers']) > 1:
+        supervise(config_dict)
+        return
+    
+    start_services(config_dict)
+    application = build_application(config_dict)
+    
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT
-    updater.idle()
+    if config_dict['webhook_url']:
+        application.run_webhook(**webhook_options(config_dict))
+    else:
+        application.run_polling()
+    stop_services()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
+import argparse
+import glob
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import camelot
 import pandas as pd
 
+from muell_calendar import (events_table, file_digest, read_calendar_csv,
+                            records_from_events, replaced, snapshot_path,
+                            write_snapshot)
+
 
 def zip_to_str_list(l):
     """takes list/tuple of lists and returns list of strings
@@ -16,8 +26,8 @@ def zip_to_str_list(l):
         rr.append(r[:-1])
     return rr
     
-def parse_calendar(fn, year) -> list:
-    """PDF parsen. fn = filename"""
+def camelot_kwargs() -> dict:
+    """table areas (one per month, six per page) and columns of the Abfuhrkalender"""
     
     # table_areas
     t_top       = 535
@@ -41,24 +51,31 @@ def parse_calendar(fn, year) -> list:
     for i in x1:
         columns.append(str([i+c for c in column_space]).replace("[", "").replace("]", ""))
 
-    # camelot parser
-    tables_lattice = camelot.read_pdf(fn,
-                            pages="1, 2",
-                            flavor='stream',
-                            table_areas = table_areas,
-                            column_tol = 0.5,
-                            row_tol = 4, # die Kalenderwochen mit in die Zeile packen
-                            columns = columns,
-                            # split_text = True,
-                            layout_kwargs={
-                                # 'word_margin'   : 0.05,
-                                'char_margin'   : 0.02,
-                            }
-                            )
+    return dict(flavor='stream',
+                table_areas = table_areas,
+                column_tol = 0.5,
+                row_tol = 4, # die Kalenderwochen mit in die Zeile packen
+                columns = columns,
+                # split_text = True,
+                layout_kwargs={
+                    # 'word_margin'   : 0.05,
+                    'char_margin'   : 0.02,
+                }
+                )
+
+def read_tables(fn, pages="1, 2") -> list:
+    """camelot parser, raw month tables of pages in order.
+    Runs in the worker processes of parse_many, so it only returns plain DataFrames."""
+    
+    tables_lattice = camelot.read_pdf(fn, pages=pages, **camelot_kwargs())
+    return [t.df for t in tables_lattice]
+
+def tables_to_calendar(tables, year) -> pd.DataFrame:
+    """month tables (January first) -> one DataFrame for the year, indexed by Datum"""
+    
     # eigene Liste bauen
     df_list = []
-    for i in tables_lattice:
-        df = i.df
+    for df in tables:
         df.columns = ["TagNr", "Wochentag", "Restmüll", "Papiermüll", "Gelber Sack"]
         df_list.append(df)
             
@@ -79,6 +96,84 @@ def parse_calendar(fn, year) -> list:
     
     return df
 
+def parse_calendar(fn, year) -> pd.DataFrame:
+    """PDF parsen. fn = filename"""
+    
+    return tables_to_calendar(read_tables(fn), year)
+
+# --- batch parsing ---
+# bump when camelot_kwargs or tables_to_calendar change, old cache entries are ignored then
+PARSER_VERSION = 1
+CACHE_DIR = ".parse_cache"
+PAGES = ["1", "2"]
+
+def year_of(fn) -> int:
+    """Abfuhrkalender_2023.pdf -> 2023"""
+    m = re.search(r"(\d{4})", os.path.basename(fn))
+    if not m:
+        raise ValueError(f"no year in {fn}, use --year")
+    return int(m.group(1))
+
+def cache_path(digest, year, cache_dir=CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f"{digest}-{year}-v{PARSER_VERSION}.csv")
+
+def write_calendar(df, year, directory="."):
+    """AK_{YEAR}_komplett.csv (as in the PDF), AK_{YEAR}_events.csv
+    (one row per date, category, district) and the binary snapshot for the bot,
+    in directory (the bot's working directory). Every file is replaced at once,
+    the running bot may be loading them."""
+    
+    # validates all cells, raises before anything is written
+    events = events_table(df)
+    
+    # csv schreiben
+    komplett = os.path.join(directory, f"AK_{year}_komplett.csv")
+    with replaced(komplett, 'w', encoding='utf-8', newline='') as f:
+        df.to_csv(f)
+    print(f"------> {komplett}", "saved")
+    with replaced(os.path.join(directory, f"AK_{year}_events.csv"), 'w', encoding='utf-8', newline='') as f:
+        events.to_csv(f, index=False)
+    print(f"------> {os.path.join(directory, f'AK_{year}_events.csv')}", "saved")
+    
+    # binary snapshot for the bot (mmap, no csv parsing at startup)
+    write_snapshot(snapshot_path(komplett), *records_from_events(events))
+    print(f"------> {snapshot_path(komplett)}", "saved")
+
+def parse_many(jobs, workers=None, cache_dir=CACHE_DIR, use_cache=True) -> dict:
+    """jobs = [(pdf filename, year), ...] -> {year: cached csv}
+    
+    Results are cached by the sha256 of the PDF, only new or changed PDFs
+    are parsed. Their pages are read in a process pool, one task per page."""
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    results = {}
+    todo = []
+    for fn, year in jobs:
+        digest = file_digest(fn)
+        results[year] = cache_path(digest, year, cache_dir)
+        if use_cache and os.path.exists(results[year]):
+            print(f"{fn}: unchanged (sha256 {digest[:12]}), cached")
+        else:
+            todo.append((fn, year))
+    
+    if todo:
+        t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {(fn, page): pool.submit(read_tables, fn, page)
+                       for fn, _ in todo for page in PAGES}
+            for fn, year in todo:
+                tables = [t for page in PAGES for t in futures[(fn, page)].result()]
+                df = tables_to_calendar(tables, year)
+                try:
+                    events_table(df)
+                except ValueError as e:
+                    raise ValueError(f"{fn}: {e}") from None
+                # write to a temp file first, a half written entry would count as cached
+                df.to_csv(results[year] + ".tmp")
+                os.replace(results[year] + ".tmp", results[year])
+        print(f"{len(todo)} PDF(s) parsed in {time.perf_counter()-t0:.1f} s")
+    return results
+
 # crontab https://crontab.guru/
 # maybe check this out https://cronitor.io/sign-up
 # $RANDOM is an internal Bash function (not a constant) that returns a pseudorandom [1] integer in the range 0 - 32767.
@@ -86,17 +181,44 @@ def parse_calendar(fn, year) -> list:
 # 0 0 * * 5 sleep "$(((($RANDOM % 48)*3600 + $RANDOM % 60))"; /path/to/executable
 # jeden Freitag
 
-def main():
+def update_calendars(jobs, workers=None, use_cache=True, directory=".") -> list:
+    """parses [(pdf, year), ...] and writes the calendar files of every year
+    whose content changed into directory, returns these years.
+    The parse cache is kept in directory as well."""
     
-    YEAR = 2023
+    written = []
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    for year, cached in parse_many(jobs, workers=workers, cache_dir=cache_dir, use_cache=use_cache).items():
+        out = os.path.join(directory, f"AK_{year}_komplett.csv")
+        if os.path.exists(out) and os.path.exists(snapshot_path(out)) \
+                and os.path.exists(os.path.join(directory, f"AK_{year}_events.csv")) \
+                and file_digest(out) == file_digest(cached):
+            # not even touched, so the bot does not look at it again
+            print(f"------> {out} up to date")
+            continue
+        write_calendar(read_calendar_csv(cached), year, directory)
+        written.append(year)
+    return written
 
+def main():
+    
+    parser = argparse.ArgumentParser(description="Abfuhrkalender PDFs -> AK_{YEAR}_komplett.csv + .muellcal")
+    parser.add_argument("pdfs", nargs="*",
+                        help="PDF files, the year is taken from the name (default: ./Abfuhrkalender_*.pdf)")
+    parser.add_argument("--year", type=int, action="append", default=[],
+                        help="parse ./Abfuhrkalender_{YEAR}.pdf, can be given several times")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("--no-cache", action="store_true", help="parse again even if the PDF is unchanged")
+    args = parser.parse_args()
+    
+    jobs = [(fn, year_of(fn)) for fn in args.pdfs]
+    jobs += [(f"./Abfuhrkalender_{year}.pdf", year) for year in args.year]
+    if not jobs:
+        jobs = [(fn, year_of(fn)) for fn in sorted(glob.glob("./Abfuhrkalender_*.pdf"))]
+    
     # parsen
-    fn = "./Abfuhrkalender_2023.pdf"
-    df = parse_calendar(fn, year = YEAR)
-        
-    # csv schreiben
-    df.to_csv(f"AK_{YEAR}_komplett.csv")
-    print(f"------> AK_{YEAR}_komplett.csv", "saved")
+    update_calendars(jobs, workers=args.workers, use_cache=not args.no_cache)
     
 if __name__ == "__main__":
     main()
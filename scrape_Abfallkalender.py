@@ -1,11 +1,190 @@
 #!/usr/bin/env python3
-# import urllib.request
-# from bs4 import BeautifulSoup
-# from parse_pdf import get_calendarweek, parse_date_from_pdf
-# from datetime import date
 """
-just download manually for now.
-Only once a year...
+Abfuhrkalender herunterladen
+
+Polls the Abfuhrkalender page of the Landratsamt, finds the PDF of the
+year and parses it only if its content changed:
+
+    - page and PDF are fetched with If-None-Match / If-Modified-Since,
+      an unchanged file costs a 304 without body
+    - servers without validators: the PDF is hashed, same hash = unchanged
+    - on a change the PDF is saved as Abfuhrkalender_{YEAR}.pdf and
+      parse_muell_pdf writes AK_{YEAR}_komplett.csv/.muellcal, which the
+      running bot picks up by itself (CalendarRegistry)
+    - validators and hashes are kept in .download_state.json, the PDF's
+      are only stored after a successful parse, so a failed parse is
+      tried again on the next poll
+
+    python scrape_Abfallkalender.py --once
+    python scrape_Abfallkalender.py --every 360
+    python scrape_Abfallkalender.py --once --url http://127.0.0.1:8082/   # fake_abfallkalender.py
 """
 
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
+
+import schedule
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
 URL = "https://www.biberach.de/de/Service-Verwaltung/Das-Landratsamt/Unsere-aemter/Abfallwirtschaftsbetrieb/Abfuhrkalender"
+STATE_FILE = ".download_state.json"
+USER_AGENT = "muellbot (Abfuhrkalender download)"
+TIMEOUT = 30 # seconds per request
+EVERY = 6 * 60 # minutes between two polls
+
+
+def load_state(fn: str = STATE_FILE) -> dict:
+    """{url: {'etag': ..., 'last_modified': ..., 'sha256': ..., ...}}"""
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_state(state: dict, fn: str = STATE_FILE):
+    directory = os.path.dirname(os.path.abspath(fn))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f.name, fn)
+
+def fetch(url: str, known: dict = None):
+    """conditional GET -> (body, validators), body is None if the server
+    answered 304 Not Modified for the validators in known"""
+
+    headers = {'User-Agent': USER_AGENT}
+    if known and known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known and known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            body = response.read()
+            validators = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified')}
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, known
+        raise
+    return body, validators
+
+def find_pdf_link(html, base_url: str, year: int):
+    """absolute url of the Abfuhrkalender PDF of year on the page, None if there is none"""
+
+    soup = BeautifulSoup(html, "html.parser")
+    candidates = []
+    for a in soup.find_all("a", href=True):
+        href = a["href"]
+        if not urlparse(href).path.lower().endswith(".pdf"):
+            continue
+        text = f"{a.get_text(' ', strip=True)} {href}"
+        if not re.search(rf"(?<!\d){year}(?!\d)", text):
+            continue
+        # links that say Abfuhrkalender first, e.g. not the Sperrmüll flyer of the same year
+        candidates.append((0 if re.search(r"abfuhr", text, re.I) else 1, urljoin(base_url, href)))
+    return min(candidates)[1] if candidates else None
+
+def pdf_path(year: int, directory: str = ".") -> str:
+    """the name parse_muell_pdf looks for"""
+    return os.path.join(directory, f"Abfuhrkalender_{year}.pdf")
+
+def check(url: str = URL, year: int = None, state_file: str = STATE_FILE, directory: str = ".") -> bool:
+    """one poll: True if a new PDF was downloaded and parsed.
+    PDF and calendar files go to directory, the bot's working directory."""
+
+    year = year or datetime.today().year
+    state = load_state(state_file)
+
+    page = state.get(url, {})
+    html, validators = fetch(url, page)
+    if html is None and page.get('pdfs', {}).get(str(year)):
+        pdf_url = page['pdfs'][str(year)]
+        logger.info("Page not modified")
+    else:
+        if html is None:
+            # 304, but the link of this year was never found, ask for the whole page
+            html, validators = fetch(url)
+        pdf_url = find_pdf_link(html, url, year)
+        page = dict(validators, pdfs=dict(page.get('pdfs', {})))
+        if pdf_url:
+            page['pdfs'][str(year)] = pdf_url
+        state[url] = page
+        save_state(state, state_file)
+    if not pdf_url:
+        logger.warning("No Abfuhrkalender %d found on %s", year, url)
+        return False
+
+    fn = pdf_path(year, directory)
+    known = state.get(pdf_url, {}) if os.path.exists(fn) else {}
+    pdf, validators = fetch(pdf_url, known)
+    if pdf is None:
+        logger.info("%s not modified", pdf_url)
+        return False
+    digest = hashlib.sha256(pdf).hexdigest()
+    if digest == known.get('sha256'):
+        logger.info("%s downloaded again, same content (sha256 %s)", pdf_url, digest[:12])
+        state[pdf_url] = dict(known, **validators)
+        save_state(state, state_file)
+        return False
+
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False, suffix='.tmp') as f:
+        f.write(pdf)
+    os.replace(f.name, fn)
+    logger.info("%s changed (sha256 %s), saved as %s", pdf_url, digest[:12], fn)
+
+    # camelot is only needed when there is something to parse
+    from parse_muell_pdf import update_calendars
+    written = update_calendars([(fn, year)], directory=directory)
+    logger.info("Calendar %d parsed, written: %s", year, written or "nothing changed")
+
+    # only now, a failed parse is tried again on the next poll
+    state[pdf_url] = dict(validators, sha256=digest, file=fn, year=year)
+    save_state(state, state_file)
+    return True
+
+def poll(url: str, years: list, state_file: str, directory: str = "."):
+    for year in years:
+        try:
+            check(url, year, state_file, directory)
+        except Exception:
+            # try again on the next poll
+            logger.exception("Checking the Abfuhrkalender %d failed", year)
+
+def main():
+    parser = argparse.ArgumentParser(description="download and parse the Abfuhrkalender PDF when it changed")
+    parser.add_argument("--url", default=URL, help="page with the link to the PDF")
+    parser.add_argument("--year", type=int, action="append", default=[],
+                        help="year of the calendar (default: this year), can be given several times")
+    parser.add_argument("--state", default=STATE_FILE, help="file with ETags and hashes")
+    parser.add_argument("--dir", default=".", help="where the PDF and the calendar files go (the bot's directory)")
+    parser.add_argument("--once", action="store_true", help="check once and exit")
+    parser.add_argument("--every", type=int, default=EVERY, help="minutes between two polls")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    years = args.year or [datetime.today().year]
+    if args.once:
+        changed = [check(args.url, year, args.state, args.dir) for year in years]
+        print("changed" if any(changed) else "unchanged")
+        return
+
+    poll(args.url, years, args.state, args.dir)
+    schedule.every(args.every).minutes.do(poll, args.url, years, args.state, args.dir)
+    while True:
+        schedule.run_pending()
+        time.sleep(30)
+
+if __name__ == "__main__":
+    main()
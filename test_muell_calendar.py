@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Tests for the calendar: cell parsing, lookups and the CalendarStore
+"""
+
+import os
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from muell_calendar import (DISTRICTS, RECORD_DTYPE, RECYCLING_BEZIRKE,
+                            RESTMUELL_BEZIRKE, Calendar, CalendarRegistry,
+                            CalendarStore, events_table, file_digest,
+                            parse_cell, write_snapshot)
+
+CATEGORIES = ['Restmüll', 'Papiermüll']
+
+CSV = """Datum,Wochentag,Restmüll,Papiermüll
+2026-01-05,Mo,Bez. 3,
+2026-01-06,Di,,D/E ohne Bez.
+"""
+
+
+@pytest.mark.parametrize("cell, districts", [
+    ("D/E ohne Bez.", ['D', 'E']),
+    ("Bez. 1, 2", ['1', '2']),
+    ("Bez. 3", ['3']),
+    ("A ", ['A']),
+    ("B und C", ['B', 'C']),
+    ("", []),
+    ("  ", []),
+])
+def test_parse_cell(cell, districts):
+    assert parse_cell(cell) == districts
+
+
+@pytest.mark.parametrize("cell", ["Bez. X", "Bez.", "ohne Bez.", "A/F", "Feiertag"])
+def test_parse_cell_rejects(cell):
+    with pytest.raises(ValueError):
+        parse_cell(cell)
+
+
+def test_parse_cell_allowed():
+    assert parse_cell("Bez. 4", RESTMUELL_BEZIRKE) == ['4']
+    with pytest.raises(ValueError):
+        parse_cell("A", RESTMUELL_BEZIRKE)
+
+
+def wide(rows):
+    df = pd.DataFrame(rows, columns=["Datum", "Wochentag", "Restmüll", "Papiermüll"])
+    df["Datum"] = pd.to_datetime(df["Datum"])
+    return df.set_index("Datum")
+
+
+def test_events_table():
+    events = events_table(wide([("2026-01-05", "Mo", "Bez. 1, 2", "D/E ohne Bez."),
+                                ("2026-01-06", "Di", "", "A und B")]))
+    assert [(str(d.date()), k, b) for d, k, b in events.itertuples(index=False)] == [
+        ("2026-01-05", "Restmüll", "1"), ("2026-01-05", "Restmüll", "2"),
+        ("2026-01-05", "Papiermüll", "D"), ("2026-01-05", "Papiermüll", "E"),
+        ("2026-01-06", "Papiermüll", "A"), ("2026-01-06", "Papiermüll", "B")]
+    assert list(events['category'].cat.categories) == ["Restmüll", "Papiermüll"]
+    assert set(events['district'].cat.categories) == set(RESTMUELL_BEZIRKE + RECYCLING_BEZIRKE)
+
+
+def test_events_table_reports_all_invalid_cells():
+    with pytest.raises(ValueError) as e:
+        events_table(wide([("2026-01-05", "Mo", "Bez. A", "Bez. 9"),
+                           ("2026-01-06", "Di", "", "")]))
+    assert "2026-01-05 Restmüll" in str(e.value)
+    assert "2026-01-05 Papiermüll" in str(e.value)
+
+
+def write(fn, text, mtime_ns=None):
+    with open(fn, 'w') as f:
+        f.write(text)
+    if mtime_ns is not None:
+        os.utime(fn, ns=(mtime_ns, mtime_ns))
+
+
+def test_store_keeps_calendar_when_the_file_does_not_parse(tmp_path, caplog, monkeypatch):
+    fn = str(tmp_path / "AK_2026_komplett.csv")
+    write(fn, CSV, 1_000_000_000)
+    store = CalendarStore(fn)
+    calendar = store.get()
+    assert calendar.categories_on(date(2026, 1, 6), '3', 'E') == ['Papiermüll']
+
+    write(fn, CSV.replace("D/E ohne Bez.", "Bez. X"), 2_000_000_000)
+    assert store.get() is calendar
+    assert store.get() is calendar
+    assert len([r for r in caplog.records if r.levelname == 'ERROR']) == 1
+
+    # not read again until it changes
+    monkeypatch.setattr('muell_calendar.file_digest', lambda fn: pytest.fail("read again"))
+    assert store.get() is calendar
+    monkeypatch.setattr('muell_calendar.file_digest', file_digest)
+
+    write(fn, CSV.replace("Bez. 3", "Bez. 4"), 3_000_000_000)
+    assert store.get().categories_on(date(2026, 1, 5), '4', 'A') == ['Restmüll']
+
+
+def test_store_without_calendar_raises_for_a_bad_file(tmp_path):
+    fn = str(tmp_path / "AK_2026_komplett.csv")
+    write(fn, CSV.replace("Bez. 3", "Bez. 9"))
+    store = CalendarStore(fn)
+    with pytest.raises(ValueError):
+        store.get()
+    with pytest.raises(ValueError):
+        store.get()
+
+
+def calendar(pickups) -> Calendar:
+    """[(day, category, district), ...]"""
+    records = np.zeros(len(pickups), dtype=RECORD_DTYPE)
+    for i, (day, category, district) in enumerate(pickups):
+        records[i] = (np.datetime64(day, 'D').astype('<i4'), CATEGORIES.index(category), DISTRICTS.index(district))
+    return Calendar(CATEGORIES, records)
+
+
+def days(found) -> dict:
+    return {str(day): categories for day, categories in found.items()}
+
+
+def test_calendar_lookups():
+    cal = calendar([(date(2026, 3, 2), 'Restmüll', '3'), (date(2026, 3, 2), 'Papiermüll', 'A'),
+                    (date(2026, 3, 9), 'Papiermüll', 'B'), (date(2026, 3, 16), 'Restmüll', '3')])
+    assert cal.categories_on(date(2026, 3, 2), '3', 'A') == ['Restmüll', 'Papiermüll']
+    assert cal.categories_on(date(2026, 3, 2), '4', 'B') == []
+    # from the day after, a lookday in the middle of a day starts at the next one
+    assert str(cal.next_pickup('3', 'B', datetime(2026, 3, 2))) == '2026-03-02'
+    assert str(cal.next_pickup('3', 'B', datetime(2026, 3, 2, 12))) == '2026-03-09'
+    assert cal.next_pickup('3', 'A', datetime(2026, 3, 17)) is None
+    # [start, end)
+    assert days(cal.pickups_between('3', 'B', date(2026, 3, 2), date(2026, 3, 16))) == {
+        '2026-03-02': ['Restmüll'], '2026-03-09': ['Papiermüll']}
+
+
+def test_calendar_lookups_over_new_year():
+    cal = calendar([(date(2026, 12, 28), 'Restmüll', '3'), (date(2027, 1, 4), 'Restmüll', '3')])
+    assert str(cal.next_pickup('3', 'A', datetime(2026, 12, 29))) == '2027-01-04'
+    assert days(cal.pickups_between('3', 'A', date(2026, 12, 25), date(2027, 1, 8))) == {
+        '2026-12-28': ['Restmüll'], '2027-01-04': ['Restmüll']}
+
+
+def test_registry_over_new_year(tmp_path):
+    # this year and the next one, the registry drops years before this one
+    year = datetime.now().year
+    for y, pickups in ((year, [(date(year, 12, 28), 'Restmüll', '3')]),
+                       (year + 1, [(date(year + 1, 1, 4), 'Restmüll', '3'),
+                                   (date(year + 1, 1, 5), 'Papiermüll', 'A')])):
+        write_snapshot(str(tmp_path / f"AK_{y}_komplett.muellcal"), CATEGORIES, calendar(pickups).records)
+    registry = CalendarRegistry(str(tmp_path))
+    assert registry.years() == [year, year + 1]
+
+    assert registry.categories_on(date(year, 12, 28), '3', 'A') == ['Restmüll']
+    assert registry.loaded_years == [year]
+
+    # continues in the next year, which is loaded on the way
+    assert str(registry.next_pickup('3', 'A', datetime(year, 12, 29))) == f'{year + 1}-01-04'
+    assert registry.loaded_years == [year, year + 1]
+    assert days(registry.pickups_between('3', 'A', date(year, 12, 25), date(year + 1, 1, 6))) == {
+        f'{year}-12-28': ['Restmüll'], f'{year + 1}-01-04': ['Restmüll'], f'{year + 1}-01-05': ['Papiermüll']}
+    assert registry.next_pickup('3', 'A', datetime(year + 1, 1, 6)) is None
+    assert registry.categories_on(date(year + 2, 1, 4), '3', 'A') == []
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for the Outbox with a fake bot
+"""
+
+import asyncio
+import time
+
+from telegram.error import NetworkError, RetryAfter
+
+from muell_delivery import Outbox
+
+
+class FakeBot:
+    """records (time, chat_id, text), raises the errors in `errors` first"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+        self.calls = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.calls.append(time.monotonic())
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+async def drain(outbox, bot, timeout=5):
+    await outbox.start(bot)
+    deadline = time.monotonic() + timeout
+    while (len(outbox) or outbox.in_flight) and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await outbox.stop()
+
+
+def test_merges_messages_of_one_chat_and_key():
+    outbox, bot = Outbox(), FakeBot()
+    outbox.send(1, key=('reminder', 1), parts=["Restmüll"], render="\n".join)
+    outbox.send(1, key=('reminder', 1), parts=["Papier", "Restmüll"], render="\n".join)
+    outbox.send(1, key=('reminder', 2), parts=["Gelber Sack"], render="\n".join)
+    outbox.send(2, "a")
+    outbox.send(2, "b")
+    asyncio.run(drain(outbox, bot))
+    assert sorted((chat_id, text) for _, chat_id, text in bot.sent) == [
+        (1, "Gelber Sack"), (1, "Restmüll\nPapier"), (2, "a"), (2, "b")]
+    assert outbox.stats['coalesced'] == 1
+
+
+def test_retry_after_pauses_all_sending():
+    outbox, bot = Outbox(), FakeBot([RetryAfter(0.3)])
+    for chat_id in range(1, 4):
+        outbox.send(chat_id, "hallo")
+    started = time.monotonic()
+    asyncio.run(drain(outbox, bot))
+    assert sorted(chat_id for _, chat_id, _ in bot.sent) == [1, 2, 3]
+    assert all(at - started >= 0.3 for at, _, _ in bot.sent)
+    assert outbox.stats['retried'] == 1
+
+
+def test_network_errors_back_off_and_give_up():
+    outbox, bot = Outbox(max_retries=1), FakeBot([NetworkError("down"), NetworkError("down")])
+    outbox.send(1, "hallo")
+    asyncio.run(drain(outbox, bot))
+    assert bot.sent == []
+    assert bot.calls[1] - bot.calls[0] >= 1
+    assert outbox.stats == {'sent': 0, 'failed': 1, 'retried': 1, 'coalesced': 0}
+
+
+def test_no_burst_over_the_global_rate():
+    outbox, bot = Outbox(global_rate=20), FakeBot()
+    for chat_id in range(1, 11):
+        outbox.send(chat_id, "hallo")
+    asyncio.run(drain(outbox, bot))
+    times = [at for at, _, _ in bot.sent]
+    assert len(times) == 10
+    assert times[-1] - times[0] >= 9 / 20 * 0.9
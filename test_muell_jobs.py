@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for the TimingWheel, with a stub JobQueue and a fixed clock
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import muell_jobs
+from muell_jobs import JobRegistry, TimingWheel, minute_of_day
+
+
+class StubJobQueue:
+    """remembers the jobs, run_due() runs the ones whose time has come"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs = [] # [when, callback, interval]
+
+    def run_once(self, callback, when, name):
+        job = Job(callback, name)
+        self.jobs.append([self.clock.now + timedelta(seconds=when), job, None])
+        return job
+
+    def run_repeating(self, callback, interval, first, name):
+        job = Job(callback, name)
+        self.jobs.append([self.clock.now + timedelta(seconds=first), job, interval])
+        return job
+
+    def run_due(self):
+        for entry in sorted(self.jobs, key=lambda e: e[0]):
+            when, job, interval = entry
+            if when > self.clock.now:
+                continue
+            asyncio.run(job.callback(Context(job)))
+            if interval is None:
+                self.jobs.remove(entry)
+            else:
+                entry[0] = when + timedelta(seconds=interval)
+
+
+class Context:
+
+    def __init__(self, job):
+        self.job = job
+
+
+class Job:
+
+    def __init__(self, callback, name):
+        self.callback = callback
+        self.name = name
+
+    def schedule_removal(self):
+        pass
+
+
+class Clock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def datetime(self):
+        clock = self
+
+        class FixedDateTime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now.astimezone(tz)
+        return FixedDateTime
+
+
+def start_wheel(monkeypatch, now, resume=None):
+    clock = Clock(now)
+    monkeypatch.setattr(muell_jobs, 'datetime', clock.datetime())
+    job_queue = StubJobQueue(clock)
+    wheel = TimingWheel(timezone.utc)
+    wheel.add(42, minute_of_day('20:00'))
+    sent = []
+
+    async def callback(context, chat_ids, due):
+        sent.append((due, sorted(chat_ids)))
+
+    if resume is not None:
+        wheel.resume(resume)
+    wheel.start(JobRegistry(job_queue), callback)
+    return clock, job_queue, sent
+
+
+def test_start_inside_reminder_minute(monkeypatch):
+    start = datetime(2026, 10, 18, 20, 0, 30, tzinfo=timezone.utc)
+    clock, job_queue, sent = start_wheel(monkeypatch, start)
+    for seconds in (0, 30, 90):
+        clock.now = start + timedelta(seconds=seconds)
+        job_queue.run_due()
+    assert sent == [(start.replace(second=0), [42])]
+
+
+def test_resume_after_downtime(monkeypatch):
+    # down from 19:58 to 20:05, the 20:00 bucket is handed out on start
+    start = datetime(2026, 10, 18, 20, 5, 10, tzinfo=timezone.utc)
+    clock, job_queue, sent = start_wheel(monkeypatch, start, resume=start.replace(minute=58, hour=19, second=0))
+    job_queue.run_due()
+    assert sent == [(start.replace(minute=0, second=0), [42])]
+
+
+def test_resume_in_the_minute_already_sent(monkeypatch):
+    start = datetime(2026, 10, 18, 20, 0, 40, tzinfo=timezone.utc)
+    clock, job_queue, sent = start_wheel(monkeypatch, start, resume=start.replace(second=0))
+    for seconds in (0, 20, 80):
+        clock.now = start + timedelta(seconds=seconds)
+        job_queue.run_due()
+    assert sent == []
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Tests for the SQLite persistence
+"""
+
+import asyncio
+
+from muell_persistence import SQLitePersistence
+from muell_shards import shard_condition, shard_of
+
+REMINDERS_ON = "json_extract(data, '$.reminders_flag') = 1"
+CHATS = [-1001, -7, -2, 1, 2, 3, 4, 5, 6]
+
+
+def fill(fn):
+    persistence = SQLitePersistence(filename=fn)
+    for chat_id in CHATS:
+        persistence.write_chat_data(chat_id, {'RM_bezirk': '3', 'reminders_flag': chat_id != 4})
+    return persistence
+
+
+def test_preload_of_one_shard(tmp_path):
+    fn = str(tmp_path / "muellbot.sqlite")
+    fill(fn)
+    for index in range(3):
+        persistence = SQLitePersistence(filename=fn, preload_chats=REMINDERS_ON + " AND " +
+                                        shard_condition('chat_id', index, 3))
+        chat_data = asyncio.run(persistence.get_chat_data())
+        assert sorted(chat_data) == [c for c in CHATS if shard_of(c, 3) == index and c != 4]
+
+
+def test_chats_are_loaded_on_first_use(tmp_path):
+    fn = str(tmp_path / "muellbot.sqlite")
+    fill(fn)
+    persistence = SQLitePersistence(filename=fn)
+
+    async def scenario():
+        assert await persistence.get_chat_data() == {}
+        data = {}
+        await persistence.refresh_chat_data(3, data)
+        assert data == {'RM_bezirk': '3', 'reminders_flag': True}
+
+        # only read once, later changes in memory are not overwritten
+        data['RM_bezirk'] = '5'
+        await persistence.refresh_chat_data(3, data)
+        assert data['RM_bezirk'] == '5'
+
+        unknown = {}
+        await persistence.refresh_chat_data(99, unknown)
+        assert unknown == {}
+
+        # unchanged data is not written again
+        changes = persistence._db.total_changes
+        await persistence.update_chat_data(3, data)
+        await persistence.update_chat_data(3, dict(data))
+        assert persistence._db.total_changes == changes + 1
+
+    asyncio.run(scenario())
+    again = {}
+    asyncio.run(SQLitePersistence(filename=fn).refresh_chat_data(3, again))
+    assert again['RM_bezirk'] == '5'
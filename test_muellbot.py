@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Tests for the reminders of muellbot across restarts: post_init and
+post_shutdown with a stub Application, the SQLite persistence and a fake bot
+"""
+
+import asyncio
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+
+import muell_jobs
+import muellbot
+from muell_calendar import DISTRICTS, RECORD_DTYPE, CalendarRegistry, write_snapshot
+from muell_delivery import Outbox
+from muell_jobs import JobRegistry, TimingWheel
+from muell_persistence import SQLitePersistence
+from test_muell_jobs import Clock, Context, StubJobQueue
+
+CHATS = list(range(1, 11))
+PRELOAD = "json_extract(data, '$.reminders_flag') = 1"
+
+
+class AsyncJobQueue(StubJobQueue):
+    """runs the due jobs on the running event loop (the Outbox lives there)"""
+
+    async def run_due(self):
+        for entry in sorted(self.jobs, key=lambda e: e[0]):
+            when, job, interval = entry
+            if when > self.clock.now:
+                continue
+            context = Context(job)
+            context.application = self.application
+            await job.callback(context)
+            if interval is None:
+                self.jobs.remove(entry)
+            else:
+                entry[0] = when + timedelta(seconds=interval)
+
+
+class FakeBot:
+    """records the messages, hangs on every one after the first `hang_after`
+    (the process is killed while they are in flight)"""
+
+    def __init__(self, sent: list, hang_after: int = None):
+        self.sent = sent
+        self.hang_after = hang_after
+        self.calls = 0
+
+    async def set_my_commands(self, commands):
+        pass
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.calls += 1
+        if self.hang_after is not None and self.calls > self.hang_after:
+            await asyncio.Event().wait()
+        self.sent.append(chat_id)
+
+
+class StubApplication:
+
+    def __init__(self, bot, job_queue, persistence, chat_data):
+        self.bot = bot
+        self.job_queue = job_queue
+        self.persistence = persistence
+        self.chat_data = chat_data
+
+
+def write_calendar(directory, pickup: date):
+    """Restmüll in Bez. 3 on pickup, nothing else"""
+    records = np.zeros(1, dtype=RECORD_DTYPE)
+    records['day'] = np.datetime64(pickup, 'D').astype('<i4')
+    records['district'] = DISTRICTS.index('3')
+    write_snapshot(str(directory / f"AK_{pickup.year}_komplett.muellcal"), ['Restmüll'], records)
+
+
+def fill_database(fn):
+    persistence = SQLitePersistence(filename=fn)
+    for chat_id in CHATS:
+        persistence.write_chat_data(chat_id, {'RM_bezirk': '3', 'REC_bezirk': 'A',
+                                              'reminders_flag': True, 'reminder_time': '20:00'})
+
+
+async def run_bot(monkeypatch, tmp_path, now, bot):
+    """one start of the bot at now -> (application, job queue), like post_init does it"""
+    clock = Clock(now)
+    monkeypatch.setattr(muell_jobs, 'datetime', clock.datetime())
+    monkeypatch.setattr(muellbot, 'WHEEL', TimingWheel(muellbot.TIMEZONE))
+    monkeypatch.setattr(muellbot, 'OUTBOX', Outbox())
+    monkeypatch.setattr(muellbot, 'JOBS', JobRegistry())
+    monkeypatch.setattr(muellbot, 'CALENDAR', CalendarRegistry(str(tmp_path)))
+    muellbot.render_message.cache_clear()
+
+    persistence = SQLitePersistence(filename=str(tmp_path / "muellbot.sqlite"), preload_chats=PRELOAD)
+    job_queue = AsyncJobQueue(clock)
+    application = job_queue.application = StubApplication(bot, job_queue, persistence,
+                                                           await persistence.get_chat_data())
+    await muellbot.post_init(application)
+    await job_queue.run_due()
+    return application, job_queue
+
+
+async def drained(expected: int, sent: list):
+    for _ in range(100):
+        if len(sent) >= expected:
+            return
+        await asyncio.sleep(0.05)
+
+
+def reminder_minute_today():
+    """20:00:30 Berlin time today, the reminders are for tomorrow"""
+    return muellbot.TIMEZONE.localize(datetime.combine(date.today(), time(20, 0, 30)))
+
+
+def test_restart_after_the_minute_drained(monkeypatch, tmp_path):
+    start = reminder_minute_today()
+    write_calendar(tmp_path, start.date() + timedelta(days=1))
+    fill_database(str(tmp_path / "muellbot.sqlite"))
+    sent = []
+
+    async def scenario():
+        application, _ = await run_bot(monkeypatch, tmp_path, start, FakeBot(sent))
+        await drained(len(CHATS), sent)
+        await muellbot.post_shutdown(application)
+
+        application, _ = await run_bot(monkeypatch, tmp_path, start + timedelta(minutes=2), FakeBot(sent))
+        await asyncio.sleep(0.3)
+        await muellbot.post_shutdown(application)
+
+    asyncio.run(scenario())
+    assert sorted(sent) == CHATS
+
+
+def test_restart_mid_drain(monkeypatch, tmp_path):
+    start = reminder_minute_today()
+    write_calendar(tmp_path, start.date() + timedelta(days=1))
+    fill_database(str(tmp_path / "muellbot.sqlite"))
+    sent = []
+
+    async def scenario():
+        # killed: no post_shutdown, the unfinished minute is handed out again
+        await run_bot(monkeypatch, tmp_path, start, FakeBot(sent, hang_after=4))
+        await drained(4, sent)
+        await asyncio.sleep(0.2)
+        assert len(sent) == 4
+        await muellbot.OUTBOX.stop(timeout=0)
+
+        application, _ = await run_bot(monkeypatch, tmp_path, start + timedelta(minutes=1), FakeBot(sent))
+        await drained(len(CHATS), sent)
+        await asyncio.sleep(0.3)
+        await muellbot.post_shutdown(application)
+
+    asyncio.run(scenario())
+    assert sorted(sent) == CHATS
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Tests for the downloader against fake_abfallkalender.py
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+import scrape_Abfallkalender
+from fake_abfallkalender import FakeAbfallkalender
+
+INDEX = '<a href="pdf/Sperrmuell_2026.pdf">Sperrmüll 2026</a>\n' \
+        '<a href="pdf/Abfuhrkalender_2026.pdf">Abfuhrkalender 2026</a>\n'
+
+
+@pytest.fixture
+def site(tmp_path):
+    fixtures = tmp_path / "fixtures"
+    (fixtures / "pdf").mkdir(parents=True)
+    (fixtures / "index.html").write_text(INDEX)
+    (fixtures / "pdf" / "Abfuhrkalender_2026.pdf").write_bytes(b"%PDF-1.4 first")
+    (tmp_path / "bot").mkdir()
+    return fixtures
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """stands in for parse_muell_pdf (camelot), records the parsed PDFs"""
+    calls = []
+    module = types.SimpleNamespace(
+        update_calendars=lambda jobs, directory: calls.append((jobs, directory)) or [2026])
+    monkeypatch.setitem(sys.modules, 'parse_muell_pdf', module)
+    return calls
+
+
+def check(fake, tmp_path):
+    return scrape_Abfallkalender.check(fake.url, 2026, str(tmp_path / "state.json"), str(tmp_path / "bot"))
+
+
+def test_download_then_not_modified(site, parsed, tmp_path):
+    fake = FakeAbfallkalender(str(site)).start()
+    try:
+        assert check(fake, tmp_path)
+        pdf = str(tmp_path / "bot" / "Abfuhrkalender_2026.pdf")
+        assert open(pdf, 'rb').read() == b"%PDF-1.4 first"
+        assert parsed == [([(pdf, 2026)], str(tmp_path / "bot"))]
+        assert fake.stats == {'200': 2, '304': 0, '404': 0}
+
+        # page and PDF answered with 304
+        assert not check(fake, tmp_path)
+        assert fake.stats == {'200': 2, '304': 2, '404': 0}
+        assert len(parsed) == 1
+
+        # a new PDF on the server
+        (site / "pdf" / "Abfuhrkalender_2026.pdf").write_bytes(b"%PDF-1.4 second")
+        assert check(fake, tmp_path)
+        assert open(pdf, 'rb').read() == b"%PDF-1.4 second"
+        assert len(parsed) == 2
+    finally:
+        fake.stop()
+
+
+def test_same_sha256_without_validators(site, parsed, tmp_path):
+    fake = FakeAbfallkalender(str(site), validators=False).start()
+    try:
+        assert check(fake, tmp_path)
+        mtime = os.stat(tmp_path / "bot" / "Abfuhrkalender_2026.pdf").st_mtime_ns
+
+        # downloaded again, same content: not saved, not parsed
+        assert not check(fake, tmp_path)
+        assert fake.stats == {'200': 4, '304': 0, '404': 0}
+        assert len(parsed) == 1
+        assert os.stat(tmp_path / "bot" / "Abfuhrkalender_2026.pdf").st_mtime_ns == mtime
+    finally:
+        fake.stop()